@@ -0,0 +1,166 @@
+# Micro-benchmarks for the bot's hot-path helpers (no discord / gemini connection needed)
+# usage: python bench.py [intent] [prompt_tokens [--count]] [paginate]
+import os
+import sys
+import timeit
+
+import bot
+
+QUESTIONS = [
+    "hi",
+    "what is a closure in javascript",
+    "write a function to reverse a linked list",
+    "difference between TCP and UDP",
+    "my docker container keeps failing with exit code 137, how do I fix it?",
+    "tell me more",
+    "explain more about the second point",
+    "can you give me a recipe for banana bread",
+    "compare react vs vue for a small project, pros and cons please",
+    "why does my python script throw a KeyError when reading the config " * 4,
+]
+
+def legacy_classify(question):
+    """The per-call keyword scans the bot did before classify_question"""
+    code_keywords = [
+        "write code", "generate code", "create a program", "write a function",
+        "write a class", "implement", "code example", "write script",
+        "programming", "function to", "class that", "code for", "write", "code"
+    ]
+    explanation_keywords = [
+        "explain", "how does", "what is", "why does", "describe",
+        "tell me about", "what are", "define", "elaborate"
+    ]
+    comparison_keywords = [
+        "difference between", "compare", "versus", "vs",
+        "better than", "pros and cons", "advantages"
+    ]
+    debug_keywords = [
+        "debug", "fix", "error", "not working", "issue",
+        "problem", "bug", "wrong", "fail", "help with"
+    ]
+    # get_enhanced_prompt
+    is_code = any(keyword in question.lower() for keyword in code_keywords)
+    is_explanation = any(keyword in question.lower() for keyword in explanation_keywords)
+    is_comparison = any(keyword in question.lower() for keyword in comparison_keywords)
+    is_debug = any(keyword in question.lower() for keyword in debug_keywords)
+    # ask (code embed)
+    is_code_response = any(keyword in question.lower() for keyword in code_keywords[:-2])
+    # get_response_title
+    is_followup = any(word in question.lower() for word in [
+        "more", "explain more", "tell me more", "elaborate",
+        "details", "examples", "continue", "what else"
+    ]) or question.lower().strip() in ["more"]
+    # Conversation.add_message
+    new_topic = not any(word in question.lower() for word in [
+        "more", "explain", "elaborate", "details", "examples", "continue"
+    ])
+    return is_code, is_explanation, is_comparison, is_debug, is_code_response, is_followup, new_topic
+
+def bench_intent(rounds=20000):
+    classify = bot.classify_question.__wrapped__  # skip the lru_cache, measure the real pass
+    results = {
+        "legacy keyword scans": timeit.timeit(lambda: [legacy_classify(q) for q in QUESTIONS], number=rounds),
+        "classify_question (uncached)": timeit.timeit(lambda: [classify(q) for q in QUESTIONS], number=rounds),
+        "classify_question (cached)": timeit.timeit(
+            lambda: [bot.classify_question(q) for q in QUESTIONS], number=rounds
+        ),
+    }
+    per_message = rounds * len(QUESTIONS)
+    print(f"intent classification, {len(QUESTIONS)} questions x {rounds} rounds")
+    for name, seconds in results.items():
+        print(f"  {name:<30} {seconds / per_message * 1e6:8.2f} us/message")
+
+def bench_prompt_tokens():
+    """Prompt size per !ask, style inlined in the user turn vs. sent as system instruction.
+
+    Uses the bot's ~4 chars/token estimate, pass --count (with GEMINI_API_KEY set) for real counts.
+    """
+    count_with_api = "--count" in sys.argv and os.getenv('GEMINI_API_KEY')
+    counter = bot.get_model(bot.MODEL_NAMES["ask"]) if count_with_api else None
+
+    def tokens(text):
+        return counter.count_tokens(text).total_tokens if counter else bot.estimate_tokens(text)
+
+    conv = bot.Conversation()
+    question = "what is the difference between a process and a thread"
+    conv.add_message("user", question)
+    print(f"prompt tokens per request ({'count_tokens api' if counter else 'estimated'}), averaged over styles")
+    print(f"  {'intent':<12} {'old user turn':>14} {'new user turn':>14} {'system instr.':>14} {'saved/request':>14}")
+    for kind in bot.INTENT_KINDS + ("general",):
+        intent = bot.Intent(kind=kind, is_casual=False, is_followup=False, new_topic=True)
+        old, new, system = [], [], []
+        for style in bot.AVAILABLE_STYLES:
+            old.append(tokens(bot.get_enhanced_prompt(question, style, conv, intent)))
+            new.append(tokens(bot.get_enhanced_prompt(question, style, conv, intent, inline_style=False)))
+            system.append(tokens(bot.get_system_instruction(style)))
+        avg = lambda values: sum(values) / len(values)
+        print(f"  {kind:<12} {avg(old):>14.0f} {avg(new):>14.0f} {avg(system):>14.0f} {avg(old) - avg(new):>14.0f}")
+    print("  system instruction tokens are still billed per request, they just leave the user turn")
+
+def legacy_split_into_messages(text, max_length=1900):
+    """The old sentence splitter (string concatenation, unused by the bot but kept for the comparison)"""
+    messages = []
+    current_message = ""
+    parts = text.split("```")
+    for i, part in enumerate(parts):
+        if i % 2 == 1:
+            if len(current_message) + len(part) + 6 > max_length:
+                if current_message:
+                    messages.append(current_message)
+                    current_message = ""
+                code_chunks = [part[i:i+max_length-8] for i in range(0, len(part), max_length-8)]
+                for chunk in code_chunks[:-1]:
+                    messages.append(f"```{chunk}```")
+                current_message = f"```{code_chunks[-1]}```" if code_chunks else ""
+            else:
+                current_message += f"```{part}```"
+        else:
+            for sentence in part.split('. '):
+                if sentence:
+                    if len(current_message) + len(sentence) + 2 > max_length:
+                        messages.append(current_message.strip())
+                        current_message = sentence + '. '
+                    else:
+                        current_message += sentence + '. '
+    if current_message:
+        messages.append(current_message.strip())
+    return messages
+
+def large_response(size=50 * 1024):
+    """Mixed prose / code answer of about size chars"""
+    prose = "This paragraph explains the next step in some detail. It has a few sentences. " * 6 + "\n\n"
+    code = "```python\n" + "".join(f"def step_{i}(value):\n    return value * {i}  # scale\n" for i in range(40)) + "```\n\n"
+    text = ""
+    while len(text) < size:
+        text += prose + code
+    return text[:size]
+
+def bench_paginate(rounds=50):
+    text = large_response()
+    pages = bot.paginate(text, bot.EMBED_DESCRIPTION_LIMIT)
+    fields = bot.paginate(text, bot.EMBED_FIELD_LIMIT)
+    # only fence lines are ever added, the rest must come back unchanged
+    def content(chunks):
+        return "".join(line for chunk in chunks for line in chunk.split("\n") if not bot.code_fence(line))
+    assert content(pages) == content([text]) == content(fields), "paginate lost content"
+
+    results = {
+        "legacy split_into_messages": timeit.timeit(lambda: legacy_split_into_messages(text, 4000), number=rounds),
+        "paginate (4096 pages)": timeit.timeit(lambda: bot.paginate(text, bot.EMBED_DESCRIPTION_LIMIT), number=rounds),
+        "paginate (1024 fields)": timeit.timeit(lambda: bot.paginate(text, bot.EMBED_FIELD_LIMIT), number=rounds),
+        "markdown_sections": timeit.timeit(lambda: bot.markdown_sections(text), number=rounds),
+    }
+    print(f"pagination of a {len(text) // 1024}KB answer ({len(pages)} pages / {len(fields)} fields, no content lost)")
+    for name, seconds in results.items():
+        print(f"  {name:<30} {seconds / rounds * 1e3:8.2f} ms/answer")
+
+BENCHMARKS = {
+    "intent": bench_intent,
+    "prompt_tokens": bench_prompt_tokens,
+    "paginate": bench_paginate,
+}
+
+if __name__ == '__main__':
+    names = [arg for arg in sys.argv[1:] if not arg.startswith("--")] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
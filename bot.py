@@ -3,23 +3,205 @@
 # Day: Thursday
 # Description : chatbot for discord using google gemini api
 # github: https://github.com/MRXz194   Discord: kz5198
+import io
 import os
+import re
 import json
+import hashlib
+import time
+import random
+import sqlite3
+import threading
+import asyncio
+import datetime
+import functools
+import contextlib
+import contextvars
+import logging
+import logging.handlers
+import queue
+import atexit
+import signal
+from collections import OrderedDict, defaultdict, deque, namedtuple
 import discord
+from aiohttp import web  # ships with discord.py
+from discord import app_commands
 from discord.ext import commands
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 
+try:
+    from PIL import Image  # optional, used to shrink big images before upload
+except ImportError:
+    Image = None
+
 
 BOT_DIR = os.path.dirname(os.path.abspath(__file__))
 SETTINGS_FILE = os.path.join(BOT_DIR, 'settings.json')
 
 load_dotenv()
 
+# Logging (json lines with the request id + command context, written by a background thread)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # json | text
+TRACING_ENABLED = os.getenv('TRACING', '0') == '1'  # opentelemetry spans, needs an sdk configured
+
+try:
+    from opentelemetry import trace  # optional, spans go to whatever exporter the sdk was set up with
+except ImportError:
+    trace = None
+
+log = logging.getLogger("gemini_bot")
+tracer = trace.get_tracer("gemini_bot") if trace and TRACING_ENABLED else None
+request_context = contextvars.ContextVar("request_context", default=None)  # dict of ids for this command
+request_timings = contextvars.ContextVar("request_timings", default=None)  # span name -> ms
+
+class RequestContextFilter(logging.Filter):
+    """Copies the current request's context onto the record before it leaves the event loop thread"""
+    def filter(self, record):
+        record.context = request_context.get() or {}
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **getattr(record, "context", {}),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Human readable variant, context and fields appended as key=value"""
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        fields = {**getattr(record, "context", {}), **getattr(record, "fields", {})}
+        return super().format(record) + "".join(f" {key}={value}" for key, value in fields.items())
+
+def setup_logging():
+    """Route every logger (discord.py's too) through a queue so handlers never block the loop"""
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter())
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # drain what's left on exit
+
+def begin_request(ctx):
+    """Tag everything logged while handling this command (including spawned tasks) with its ids"""
+    request_context.set({
+        "request_id": f"{ctx.message.id:x}",
+        "command": ctx.command.qualified_name if ctx.command else None,
+        "user_id": ctx.author.id,
+        "guild_id": ctx.guild.id if ctx.guild else None,
+        "channel_id": ctx.channel.id,
+        "message_id": ctx.message.id,
+    })
+    request_timings.set({})
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Time a step of the current request (shows up in its log line, and as an otel span if enabled)"""
+    start = time.perf_counter()
+    with tracer.start_as_current_span(name, attributes=attributes) if tracer else contextlib.nullcontext():
+        try:
+            yield
+        finally:
+            timings = request_timings.get()
+            if timings is not None:
+                timings[f"{name}_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+
+# Slash commands work without reading message content; MESSAGE_CONTENT_INTENT=0 drops the privileged
+# intent (and with it the ! commands outside DMs) so discord stops sending us every message's text
+SLASH_COMMANDS = os.getenv('SLASH_COMMANDS', '1') == '1'
+SLASH_SYNC_GUILD = os.getenv('SLASH_SYNC_GUILD')  # guild id to sync to instead of globally (testing)
+# syncing is rate limited and only needed when the commands change: !sync_commands, or 1 = on every start
+SLASH_SYNC_ON_START = os.getenv('SLASH_SYNC_ON_START', '0') == '1'
+MESSAGE_CONTENT_INTENT = os.getenv('MESSAGE_CONTENT_INTENT', '1') == '1'
 
 intents = discord.Intents.default()
-intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents, help_command=None)
+intents.message_content = MESSAGE_CONTENT_INTENT
+
+# Sharding. Unset = one gateway connection. SHARD_COUNT=auto lets discord pick the count (one process),
+# a number + SHARD_IDS runs only those shards in this process (see launcher.py for several workers).
+# Discord routes every guild to exactly one shard, (guild_id >> 22) % shard_count, and DMs to shard 0,
+# so a conversation (user + channel) is only ever served by the worker running that shard.
+SHARD_COUNT = os.getenv('SHARD_COUNT', '')
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id.strip()] or None
+# worker processes sharing the gemini quota, only when this process is one of them (launcher.py sets SHARD_IDS)
+SHARD_WORKERS = max(1, int(os.getenv('SHARD_WORKERS', '1'))) if SHARD_IDS else 1
+
+class BotLifecycle:
+    """Starts and flushes the background stores with the connection"""
+    metrics_runner = None
+
+    async def setup_hook(self):
+        # a service manager (or launcher.py) stops us with SIGTERM, close like Ctrl+C so the stores flush
+        with contextlib.suppress(NotImplementedError):  # no signal handlers on windows
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        await settings_store.start()
+        await conversation_store.start()
+        if analysis_cache:
+            await analysis_cache.start()
+        if METRICS_ENABLED and METRICS_PORT:
+            self.metrics_runner = await start_metrics_server()
+        if SLASH_COMMANDS and SLASH_SYNC_ON_START and (not SHARD_IDS or 0 in SHARD_IDS):  # one worker syncs for everyone
+            await sync_slash_commands()
+
+    async def invoke(self, ctx):
+        """Run every command inside its priority lane"""
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        try:
+            async with lanes[command_lane(ctx)].slot():
+                await super().invoke(ctx)
+        except LaneFull as e:  # before_invoke / after_invoke never ran
+            await start_request(ctx)
+            await shed_request(ctx, e)
+            await finish_request(ctx)
+
+    async def close(self):
+        if self.metrics_runner:
+            await self.metrics_runner.cleanup()
+        await conversation_store.close()
+        await settings_store.close()
+        await super().close()
+
+class GeminiBot(BotLifecycle, commands.Bot):
+    pass
+
+class ShardedGeminiBot(BotLifecycle, commands.AutoShardedBot):
+    pass
+
+def make_bot():
+    options = dict(command_prefix='!', intents=intents, help_command=None)
+    if not SHARD_COUNT:
+        return GeminiBot(**options)
+    if SHARD_COUNT == 'auto':
+        return ShardedGeminiBot(**options)
+    return ShardedGeminiBot(shard_count=int(SHARD_COUNT), shard_ids=SHARD_IDS, **options)
+
+bot = make_bot()
+
+def shard_for(guild_id):
+    """Shard discord delivers this guild's events to (DMs always go to shard 0)"""
+    if guild_id is None or not bot.shard_count:
+        return 0
+    return (guild_id >> 22) % bot.shard_count
 
 # styles
 AVAILABLE_STYLES = {
@@ -33,74 +215,191 @@ AVAILABLE_STYLES = {
     "teaching": "explain step by step"
 }
 
-def get_style_prompt(style):
-    """Get the appropriate prompt modification based on style"""
-    style_prompts = {
-        "professional": """Maintain a professional tone:
+# Prompt templates (built-in defaults, PROMPTS_FILE can override any of them without a redeploy)
+PROMPTS_FILE = os.getenv('PROMPTS_FILE', os.path.join(BOT_DIR, 'prompts.json'))
+
+DEFAULT_STYLE_PROMPTS = {
+    "professional": """Maintain a professional tone:
 - Use formal language and proper terminology
 - Structure responses clearly and logically
 - Stay objective and business-focused
 - Avoid casual language and emojis""",
 
-        "friendly": """Be warm and approachable:
+    "friendly": """Be warm and approachable:
 - Use casual, conversational language
 - Include appropriate emojis occasionally 😊
 - Be encouraging and supportive
 - Keep the tone light and engaging""",
 
-        "concise": """Be direct and precise:
+    "concise": """Be direct and precise:
 - Get straight to the point
 - Focus on essential information
 - Use clear, short sentences
 - Avoid unnecessary elaboration""",
 
-        "detailed": """Provide comprehensive information:
+    "detailed": """Provide comprehensive information:
 - Give thorough explanations
 - Include relevant examples
 - Cover multiple aspects of the topic
 - Provide context and background""",
 
-        "simple": """Keep it easy to understand:
+    "simple": """Keep it easy to understand:
 - Use simple, everyday language
 - Avoid technical jargon
 - Explain concepts clearly
 - Use relatable examples""",
 
-        "technical": """Focus on technical accuracy:
+    "technical": """Focus on technical accuracy:
 - Use proper technical terminology
 - Include technical specifications
 - Provide detailed technical explanations
 - Reference technical standards when relevant""",
 
-        "creative": """Be imaginative and engaging:
+    "creative": """Be imaginative and engaging:
 - Use creative analogies
 - Include interesting examples
 - Make explanations engaging
 - Think outside the box""",
 
-        "teaching": """Adopt an educational approach:
+    "teaching": """Adopt an educational approach:
 - Break down concepts step by step
 - Provide clear examples
 - Check understanding
 - Build on previous knowledge"""
-    }
-    
-    return style_prompts.get(style, style_prompts["friendly"])
+}
+
+DEFAULT_STYLE_CONFIGS = {
+    "professional": {"temperature": 0.3, "top_p": 0.85},  # More consistent, formal responses
+    "friendly": {"temperature": 0.7, "top_p": 0.95},      # More varied, casual responses
+    "concise": {"temperature": 0.2, "top_p": 0.8},        # Very focused responses
+    "detailed": {"temperature": 0.4, "top_p": 0.9},       # Balanced detail and coherence
+    "simple": {"temperature": 0.3, "top_p": 0.85},        # Clear, straightforward responses
+    "technical": {"temperature": 0.2, "top_p": 0.8},      # Precise technical responses
+    "creative": {"temperature": 0.8, "top_p": 0.95},      # More creative variation
+    "teaching": {"temperature": 0.4, "top_p": 0.9}        # Balanced teaching responses
+}
+
+DEFAULT_INTENT_TEMPLATES = {
+    "code": """Generate code based on the request below.
+
+Requirements:
+1. Write clean, efficient code
+2. Include necessary imports
+3. Add brief comments
+4. Use proper formatting
+
+Format the response as:
+```python
+# Your code here
+```
+
+Keep the code concise and focused.""",
+
+    "explanation": """Provide a clear and comprehensive explanation.
+
+Guidelines:
+- Start with a concise overview
+- Break down complex concepts
+- Use analogies when helpful
+- Provide relevant examples
+- Include practical applications
+- Address common misconceptions""",
+
+    "comparison": """Compare and contrast the subjects thoroughly.
+
+Structure:
+1. Brief overview of both subjects
+2. Key differences
+3. Key similarities
+4. Pros and cons of each
+5. Common use cases
+6. Recommendation if applicable""",
+
+    "debug": """Help debug and fix the issue.
+
+Approach:
+1. Identify potential issues
+2. Suggest solutions
+3. Explain why the problem occurs
+4. Provide corrected code if applicable
+5. Suggest preventive measures""",
+
+    "general": """Provide a helpful and informative response.
+
+Guidelines:
+- Be accurate and up-to-date
+- Include relevant examples
+- Explain any technical terms
+- Provide practical applications
+- Consider different perspectives""",
+}
+
+DEFAULT_RESPONSE_GUIDELINES = """Response Guidelines:
+- Be clear and concise
+- Use markdown formatting for better readability
+- Include relevant examples
+- Cite sources if applicable
+- Maintain the specified conversation style
+- If uncertain, acknowledge limitations"""
+
+# active templates, rebuilt by load_prompts()
+prompts = {}
+
+def load_prompts():
+    """Load PROMPTS_FILE overrides and precompute the static prompt prefix for every style and intent.
+
+    The file is optional json: {"styles": {style: text}, "style_configs": {style: {"temperature": .., "top_p": ..}},
+    "intents": {kind: text}, "response_guidelines": text}
+    """
+    try:
+        with open(PROMPTS_FILE, 'r') as f:
+            overrides = json.load(f)
+    except FileNotFoundError:
+        overrides = {}
+
+    styles = {**DEFAULT_STYLE_PROMPTS, **overrides.get("styles", {})}
+    style_configs = {**DEFAULT_STYLE_CONFIGS, **overrides.get("style_configs", {})}
+    intents = {**DEFAULT_INTENT_TEMPLATES, **overrides.get("intents", {})}
+    guidelines = overrides.get("response_guidelines", DEFAULT_RESPONSE_GUIDELINES)
+
+    # static part first and byte-identical across requests, only the tail (context + question) varies
+    prefixes = {}
+    for style, style_prompt in styles.items():
+        for kind, template in intents.items():
+            if kind == "code":
+                prefixes[style, kind] = template
+            else:
+                prefixes[style, kind] = f"{template}\n\n{style_prompt}\n\n{guidelines}"
+
+    # for models with system instructions the style + guidelines move out of the user turn
+    system_instructions = {style: f"{style_prompt}\n\n{guidelines}" for style, style_prompt in styles.items()}
+
+    prompts.update(styles=styles, style_configs=style_configs, intents=intents, prefixes=prefixes,
+                   system_instructions=system_instructions)
+    generation_config_for.cache_clear()
+
+def get_style_prompt(style):
+    """Get the appropriate prompt modification based on style"""
+    styles = prompts["styles"]
+    return styles.get(style, styles["friendly"])
 
 def get_style_config(style):
     """Get generation config modifications based on style"""
-    style_configs = {
-        "professional": {"temperature": 0.3, "top_p": 0.85},  # More consistent, formal responses
-        "friendly": {"temperature": 0.7, "top_p": 0.95},      # More varied, casual responses
-        "concise": {"temperature": 0.2, "top_p": 0.8},        # Very focused responses
-        "detailed": {"temperature": 0.4, "top_p": 0.9},       # Balanced detail and coherence
-        "simple": {"temperature": 0.3, "top_p": 0.85},        # Clear, straightforward responses
-        "technical": {"temperature": 0.2, "top_p": 0.8},      # Precise technical responses
-        "creative": {"temperature": 0.8, "top_p": 0.95},      # More creative variation
-        "teaching": {"temperature": 0.4, "top_p": 0.9}        # Balanced teaching responses
-    }
+    style_configs = prompts["style_configs"]
     return style_configs.get(style, style_configs["friendly"])
 
+def get_prompt_prefix(style, kind, inline_style=True):
+    """Precomputed static instructions for a style and intent (without the style part when it's a system instruction)"""
+    if not inline_style:
+        return prompts["intents"][kind]
+    prefixes = prompts["prefixes"]
+    return prefixes.get((style, kind)) or prefixes[("friendly", kind)]
+
+def get_system_instruction(style):
+    """Style guidelines + response guidelines, sent as the model's system instruction"""
+    system_instructions = prompts["system_instructions"]
+    return system_instructions.get(style, system_instructions["friendly"])
+
 # Default 
 DEFAULT_SETTINGS = {
     "temperature": 0.3,  # Lower temperature for more consistent responses
@@ -109,44 +408,596 @@ DEFAULT_SETTINGS = {
     "style": "friendly"
 }
 
+# Write-behind (state changes are queued and written off the event loop in batches)
+STORE_FLUSH_INTERVAL = float(os.getenv('STORE_FLUSH_INTERVAL', '1.0'))  # seconds between write-behind batches
+STORE_FLUSH_BATCH = 500  # flush early once this many writes are queued
+
+class WriteBehind:
+    """Mixin for stores that flush queued writes from a background task"""
+    def init_write_behind(self):
+        self.flush_wanted = asyncio.Event()
+        self.flush_task = None
+        self.stopping = False
+        self.flushes = 0
+
+    async def flush(self):
+        raise NotImplementedError
+
+    async def flush_loop(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.flush_wanted.wait(), timeout=STORE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_wanted.clear()
+            await self.flush()
+
+    async def start(self):
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_loop())
+
+    async def stop_flushing(self):
+        """Let the background task finish the flush it's in (never cancel a write halfway), then write the rest.
+
+        Only after this returns is it safe to close the connections the flush thread uses.
+        """
+        if self.flush_task:
+            self.stopping = True
+            self.flush_wanted.set()  # wake it now instead of after the interval
+            await self.flush_task
+            self.flush_task = None
+        await self.flush()
+
 # User storage
-user_settings = {}
+SETTINGS_BACKEND = os.getenv('SETTINGS_BACKEND', 'json')  # json | sqlite
+SETTINGS_DB = os.getenv('SETTINGS_DB', os.path.join(BOT_DIR, 'settings.db'))
 
-def load_settings():
-    try:
-        with open(SETTINGS_FILE, 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
+class SettingsStore(WriteBehind):
+    """User settings in memory, changed users flushed to settings.json with an atomic rename.
+
+    Users who never changed anything are not stored, they just get the defaults.
+    """
+    def __init__(self):
+        self.settings = self.load()
+        self.dirty = set()  # user ids changed since the last flush
+        self.init_write_behind()
+
+    def load(self):
+        try:
+            with open(SETTINGS_FILE, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def get(self, user_id):
+        """Settings for a user, a fresh default copy if they never changed any"""
+        stored = self.settings.get(str(user_id))
+        return stored if stored is not None else DEFAULT_SETTINGS.copy()
+
+    def set(self, user_id, settings):
+        self.settings[str(user_id)] = settings
+        self.mark_dirty(str(user_id))
+
+    def reset(self, user_id):
+        if self.settings.pop(str(user_id), None) is not None:
+            self.mark_dirty(str(user_id))
+
+    def mark_dirty(self, key):
+        self.dirty.add(key)
+        if len(self.dirty) >= STORE_FLUSH_BATCH:
+            self.flush_wanted.set()
+
+    def snapshot(self, changed):
+        """Copy what needs writing, taken on the loop so the thread never sees a dict mid-update"""
+        return {user_id: dict(settings) for user_id, settings in self.settings.items()}  # inner dicts change too
+
+    def write(self, snapshot):
+        """Persist a snapshot (runs in a worker thread)"""
+        tmp_file = SETTINGS_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, SETTINGS_FILE)  # atomic, a crash leaves the old file intact
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        changed, self.dirty = self.dirty, set()
+        try:
+            await asyncio.to_thread(self.write, self.snapshot(changed))
+            self.flushes += 1
+        except Exception as e:
+            log.warning("saving settings failed, retrying next flush", exc_info=e)
+            self.dirty |= changed  # retry next round
+
+    async def close(self):
+        await self.stop_flushing()
+
+class SQLiteSettingsStore(SettingsStore):
+    """Settings in SQLite so a flush only touches the changed users.
+
+    Safe to share between worker processes: every flush also picks up what other workers committed.
+    """
+    def load(self):
+        self.db = sqlite3.connect(SETTINGS_DB, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS user_settings (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        rows = self.db.execute("SELECT user_id, data FROM user_settings").fetchall()
+        if rows:
+            settings = {user_id: json.loads(data) for user_id, data in rows}
+        else:
+            # first run on sqlite, import the old json file
+            settings = super().load()
+            with self.db:
+                self.db.executemany(
+                    "INSERT INTO user_settings (user_id, data) VALUES (?, ?)",
+                    [(user_id, json.dumps(data)) for user_id, data in settings.items()]
+                )
+        self.data_version = self.db.execute("PRAGMA data_version").fetchone()[0]  # read_changes compares against it
+        return settings
+
+    def read_changes(self):
+        """All rows if another connection committed since the last look, else None (worker thread)"""
+        data_version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self.data_version:
+            return None
+        self.data_version = data_version
+        return self.db.execute("SELECT user_id, data FROM user_settings").fetchall()
+
+    async def flush(self):
+        await super().flush()
+        if not SHARD_COUNT:
+            return  # nobody else writes the db
+        try:
+            rows = await asyncio.to_thread(self.read_changes)
+        except Exception as e:
+            log.warning("reading settings from other workers failed", exc_info=e)
+            return
+        if rows is not None:
+            settings = {user_id: json.loads(data) for user_id, data in rows}
+            for user_id in self.dirty:  # changed here since, not written yet
+                if user_id in self.settings:
+                    settings[user_id] = self.settings[user_id]
+                else:
+                    settings.pop(user_id, None)
+            self.settings = settings
+
+    def snapshot(self, changed):
+        return [(user_id, json.dumps(self.settings[user_id]) if user_id in self.settings else None)
+                for user_id in changed]
+
+    def write(self, snapshot):
+        with self.db:
+            for user_id, data in snapshot:
+                if data is None:
+                    self.db.execute("DELETE FROM user_settings WHERE user_id = ?", (user_id,))
+                else:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO user_settings (user_id, data) VALUES (?, ?)",
+                        (user_id, data)
+                    )
 
-def save_settings():
-    with open(SETTINGS_FILE, 'w') as f:
-        json.dump(user_settings, f)
+    async def close(self):
+        await super().close()
+        self.db.close()
 
-# Load setting
-user_settings = load_settings()
+settings_store = SQLiteSettingsStore() if SETTINGS_BACKEND == 'sqlite' else SettingsStore()
 
 def get_user_settings(user_id):
-    if str(user_id) not in user_settings:
-        user_settings[str(user_id)] = DEFAULT_SETTINGS.copy()
-        save_settings()
-    return user_settings[str(user_id)]
+    return settings_store.get(user_id)
 
 # Configure Gemini 
-def get_generation_config(user_id):
-    settings = get_user_settings(user_id)
-    style_config = get_style_config(settings["style"])
-    
+@functools.lru_cache(maxsize=None)  # styles x token limits is a small, fixed set
+def generation_config_for(style, max_tokens):
+    """Shared GenerationConfig for a style and token limit"""
+    style_config = get_style_config(style)
+
     return genai.types.GenerationConfig(
         temperature=style_config["temperature"],
         top_p=style_config["top_p"],
         top_k=40,
-        max_output_tokens=settings["max_tokens"],
+        max_output_tokens=max_tokens,
         candidate_count=1,
     )
 
+load_prompts()
+
 genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-model = genai.GenerativeModel('gemini-pro')
+
+# Models per command (each is created once and reused)
+MODEL_NAMES = {
+    "ask": os.getenv('ASK_MODEL', 'gemini-pro'),
+    "ask_image": os.getenv('ASK_IMAGE_MODEL', 'gemini-pro-vision'),
+    "analyze": os.getenv('ANALYZE_MODEL', 'gemini-1.5-flash'),
+    "summarize": os.getenv('SUMMARIZE_MODEL', 'gemini-pro'),
+}
+models = {}
+
+def get_model(name, system_instruction=None):
+    """Model registry, GenerativeModel objects are built on first use"""
+    key = (name, system_instruction)
+    if key not in models:
+        if system_instruction:
+            models[key] = genai.GenerativeModel(name, system_instruction=system_instruction)
+        else:
+            models[key] = genai.GenerativeModel(name)
+    return models[key]
+
+def model_for(command):
+    return get_model(MODEL_NAMES[command])
+
+# System instructions (style text goes in the model's system instruction instead of every user turn)
+SYSTEM_INSTRUCTIONS = os.getenv('SYSTEM_INSTRUCTIONS', '1') == '1'
+
+def supports_system_instruction(name):
+    """gemini 1.0 models (gemini-pro, gemini-pro-vision) reject system_instruction"""
+    name = name.removeprefix("models/")
+    return not (name in ("gemini-pro", "gemini-pro-vision") or name.startswith("gemini-1.0"))
+
+def styled_model_for(command, style, name=None):
+    """Model for a styled command, returns (model, style_in_system_instruction)"""
+    name = name or MODEL_NAMES[command]
+    if not (SYSTEM_INSTRUCTIONS and supports_system_instruction(name)):
+        return get_model(name), False
+    return get_model(name, get_system_instruction(style)), True
+
+# Metrics (prometheus text on METRICS_PORT + !stats; METRICS=0 turns every call into a no-op)
+METRICS_ENABLED = os.getenv('METRICS', '1') == '1'
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # 0 = no http endpoint
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    """Cumulative-bucket latency histogram"""
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class Metrics:
+    """Counters and histograms recorded on the hot path, store stats collected only when scraped"""
+    def __init__(self):
+        self.counters = defaultdict(float)  # (name, labels) -> value
+        self.histograms = defaultdict(Histogram)  # (name, labels) -> Histogram
+        self.collectors = {}  # prefix -> (fn returning a stats dict, label name or None)
+
+    def inc(self, name, amount=1, **labels):
+        self.counters[name, tuple(sorted(labels.items()))] += amount
+
+    def observe(self, name, seconds, **labels):
+        self.histograms[name, tuple(sorted(labels.items()))].observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def collect(self, prefix, fn, label=None):
+        """Export fn()'s numeric stats as gauges named bot_<prefix>_<stat>.
+
+        With a label, fn returns {label value: stats dict} and every gauge gets that label.
+        """
+        self.collectors[prefix] = (fn, label)
+
+    def render(self):
+        """Prometheus text exposition format"""
+        def series(name, labels, extra=()):
+            pairs = ",".join(f'{key}="{value}"' for key, value in (*labels, *extra))
+            return f"{name}{{{pairs}}}" if pairs else name
+
+        lines = []
+        typed = set()  # one TYPE line per metric family
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items(), key=series_order):
+            declare(name, "counter")
+            lines.append(f"{series(name, labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=series_order):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f"{series(name + '_bucket', labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{series(name + '_bucket', labels, [('le', '+Inf')])} {histogram.count}")
+            lines.append(f"{series(name + '_sum', labels)} {histogram.sum}")
+            lines.append(f"{series(name + '_count', labels)} {histogram.count}")
+        for prefix, (fn, label) in self.collectors.items():
+            try:
+                stats = fn()
+            except Exception as e:
+                log.warning("collecting metrics failed", extra={"fields": {"collector": prefix}}, exc_info=e)
+                continue
+            families = defaultdict(list)  # stat -> [(labels, value)], each family's lines stay together
+            for label_value, group in (stats.items() if label else [(None, stats)]):
+                for stat, value in group.items():
+                    if isinstance(value, (int, float)):
+                        families[stat].append(([(label, label_value)] if label else [], value))
+            for stat, samples in families.items():
+                declare(f"bot_{prefix}_{stat}", "gauge")
+                for labels, value in samples:
+                    lines.append(f"{series(f'bot_{prefix}_{stat}', labels)} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+    def latency_summary(self):
+        """count / p50 / p95 per histogram for !stats"""
+        return {
+            series_name(name, labels): f"n={h.count} p50≤{h.quantile(0.5)}s p95≤{h.quantile(0.95)}s"
+            for (name, labels), h in sorted(self.histograms.items(), key=series_order)
+        }
+
+    def counter_summary(self):
+        return {series_name(name, labels): int(value) for (name, labels), value in sorted(self.counters.items(), key=series_order)}
+
+def series_name(name, labels):
+    return name + "".join(f"[{value}]" for _, value in labels)
+
+def series_order(item):
+    """Sort key for (name, labels) series, label values compared as text so None or ints never meet a str"""
+    (name, labels), _ = item
+    return name, [(key, str(value)) for key, value in labels]
+
+class NullMetrics(Metrics):
+    """METRICS=0: nothing is recorded"""
+    def inc(self, name, amount=1, **labels):
+        pass
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return contextlib.nullcontext()
+
+metrics = Metrics() if METRICS_ENABLED else NullMetrics()
+
+async def start_metrics_server():
+    """Serve /metrics on METRICS_HOST:METRICS_PORT, returns the runner to clean up on close"""
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    log.info("metrics endpoint started", extra={"fields": {"url": f"http://{METRICS_HOST}:{METRICS_PORT}/metrics"}})
+    return runner
+
+# Async inference (never block the gateway loop while gemini is thinking)
+GEMINI_CONCURRENCY = int(os.getenv('GEMINI_CONCURRENCY', '8'))  # max in-flight gemini calls
+gemini_semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+# Resilience (retry transient errors with backoff, fail fast while gemini is down)
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '3'))
+GEMINI_BACKOFF_BASE = float(os.getenv('GEMINI_BACKOFF_BASE', '0.5'))  # seconds, doubled per attempt
+GEMINI_BACKOFF_MAX = 8.0
+GEMINI_DEADLINE = float(os.getenv('GEMINI_DEADLINE', '60'))  # total seconds per call including retries
+
+class GeminiError(Exception):
+    """Gemini call failed, user_message is safe to show in discord"""
+    user_message = "❌ An error occurred. Please try asking in a different way."
+    transient = False  # worth retrying / counts against the circuit breaker
+
+class GeminiQuotaError(GeminiError):
+    user_message = "❌ API quota exceeded."
+    transient = True
+
+class GeminiUnavailableError(GeminiError):
+    user_message = "❌ Gemini is having trouble right now. Please try again in a moment."
+    transient = True
+
+class GeminiBlockedError(GeminiError):
+    user_message = "❌ I cannot provide a response to that type of question"
+
+class CircuitOpenError(GeminiError):
+    user_message = "❌ Gemini is temporarily unavailable, please try again in a bit."
+
+def classify_error(e):
+    """Map an SDK / transport exception to a GeminiError subclass"""
+    if isinstance(e, GeminiError):
+        return e
+    if isinstance(e, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+        error_class = GeminiQuotaError
+    elif isinstance(e, (google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError,
+                        google_exceptions.DeadlineExceeded, google_exceptions.GatewayTimeout,
+                        asyncio.TimeoutError, ConnectionError)):
+        error_class = GeminiUnavailableError
+    elif isinstance(e, (genai.types.BlockedPromptException, genai.types.StopCandidateException)):
+        error_class = GeminiBlockedError
+    else:
+        error_class = GeminiError
+    error = error_class(str(e))
+    error.__cause__ = e
+    return error
+
+class CircuitBreaker:
+    """Opens when too many recent calls failed, lets one probe through after the cooldown.
+
+    A probe that never reports back (cancelled, or stuck past another cooldown) doesn't keep the circuit shut.
+    """
+    def __init__(self, window=20, min_calls=10, failure_rate=0.5, cooldown=30.0):
+        self.outcomes = deque(maxlen=window)  # True = success
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.cooldown = cooldown
+        self.state = "closed"  # closed | open | half_open
+        self.opened_at = 0.0
+        self.trips = 0
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if time.monotonic() - self.opened_at >= self.cooldown:  # open long enough, or the last probe went stale
+            self.state = "half_open"  # this caller is the probe
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def abandon(self):
+        """The call ended without an outcome (cancelled), let the next caller probe instead"""
+        if self.state == "half_open":
+            self.state = "open"
+            self.opened_at = time.monotonic() - self.cooldown
+
+    def record(self, success):
+        if self.state == "half_open":
+            if success:
+                self.state = "closed"
+                self.outcomes.clear()
+            else:
+                self.open()
+            return
+        self.outcomes.append(success)
+        failures = self.outcomes.count(False)
+        if len(self.outcomes) >= self.min_calls and failures / len(self.outcomes) >= self.failure_rate:
+            self.open()
+
+    def open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.trips += 1
+
+    def stats(self):
+        return {"state": self.state, "trips": self.trips, "recent_failures": self.outcomes.count(False)}
+
+circuit_breaker = CircuitBreaker()
+
+async def call_gemini(fn, *args, deadline=GEMINI_DEADLINE, keep_slot=False, **kwargs):
+    """Await fn(*args, **kwargs) with a concurrency slot, jittered backoff retries and the circuit breaker.
+
+    With keep_slot the slot stays taken after a successful call and the caller releases it.
+    """
+    loop = asyncio.get_running_loop()
+    give_up_at = loop.time() + deadline
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        if not circuit_breaker.allow():
+            raise CircuitOpenError("circuit breaker is open")
+        try:
+            await gemini_semaphore.acquire()
+            try:
+                result = await asyncio.wait_for(fn(*args, **kwargs), timeout=max(0.1, give_up_at - loop.time()))
+            except BaseException:
+                gemini_semaphore.release()
+                raise
+            if not keep_slot:
+                gemini_semaphore.release()
+        except Exception as e:
+            error = classify_error(e)
+            metrics.inc("bot_gemini_errors_total", error=type(error).__name__)
+            circuit_breaker.record(not error.transient)
+            delay = min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+            if not error.transient or attempt == GEMINI_MAX_RETRIES or loop.time() + delay >= give_up_at:
+                raise error from e
+            await asyncio.sleep(delay)
+        except BaseException:  # cancelled, says nothing about gemini
+            circuit_breaker.abandon()
+            raise
+        else:
+            circuit_breaker.record(True)
+            return result
+
+# Request coalescing (identical requests in flight at the same time share one upstream call)
+class SingleFlight:
+    """Runs one fn per key at a time, concurrent callers with the same key get the same result"""
+    def __init__(self):
+        self.calls = {}  # key -> future of the running call
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key, fn):
+        """Await fn() or join an identical call in flight, returns (result, shared)"""
+        future = self.calls.get(key)
+        if future is not None:
+            self.followers += 1
+            try:
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # this caller was cancelled, not the leader
+            # the leader was cancelled (its user gave up), run it again rather than fail everyone who joined
+            return await self.do(key, fn)
+
+        future = asyncio.get_running_loop().create_future()
+        self.calls[key] = future
+        self.leaders += 1
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # followers re-raise it, don't warn when there are none
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self.calls[key]
+
+    def stats(self):
+        return {"in_flight": len(self.calls), "upstream_calls": self.leaders, "coalesced": self.followers}
+
+inflight = SingleFlight()
+
+def request_key(*parts):
+    """Digest identifying an upstream request (model, prompt, config, history...)"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+async def generate_content_async(gen_model, prompt, **kwargs):
+    """Run generate_content on the SDK's async API, bounded by GEMINI_CONCURRENCY"""
+    return await call_gemini(gen_model.generate_content_async, prompt, **kwargs)
+
+async def send_message_async(chat, prompt, **kwargs):
+    """Run chat.send_message on the SDK's async API, bounded by GEMINI_CONCURRENCY"""
+    return await call_gemini(chat.send_message_async, prompt, **kwargs)
+
+async def stream_message_async(chat, prompt, **kwargs):
+    """Stream chat.send_message chunks, holding one concurrency slot from opening the stream until it ends.
+
+    Only opening the stream is retried, a failure halfway through is raised as is.
+    """
+    response = await call_gemini(chat.send_message_async, prompt, stream=True, keep_slot=True, **kwargs)
+    try:
+        async for chunk in response:
+            yield chunk
+    except Exception as e:
+        error = classify_error(e)
+        metrics.inc("bot_gemini_errors_total", error=type(error).__name__)
+        raise error from e
+    finally:
+        gemini_semaphore.release()
 
 # Image onfig
 SUPPORTED_IMAGE_TYPES = {
@@ -156,7 +1007,7 @@ SUPPORTED_IMAGE_TYPES = {
     'image/webp': '.webp'
 }
 
-MAX_IMAGE_SIZE = 4 * 1024 * 1024  # 4MB limit
+MAX_IMAGE_SIZE = 4 * 1024 * 1024  # 4MB limit (sent to gemini, after shrinking)
 
 def process_image_response(response_text, is_casual=False):
     """Process image analysis response based on style"""
@@ -164,13 +1015,118 @@ def process_image_response(response_text, is_casual=False):
         return f"👀 Here's what I see: {response_text}"
     return f"Image Analysis:\n{response_text}"
 
+# Intent classification (one regex pass per question, shared by prompt building, titles and topic tracking)
+INTENT_KEYWORDS = {
+    "code": [
+        "write code", "generate code", "create a program", "write a function",
+        "write a class", "implement", "code example", "write script",
+        "programming", "function to", "class that", "code for"
+    ],
+    "explanation": [
+        "explain", "how does", "what is", "why does", "describe",
+        "tell me about", "what are", "define", "elaborate"
+    ],
+    "comparison": [
+        "difference between", "compare", "versus", "vs",
+        "better than", "pros and cons", "advantages"
+    ],
+    "debug": [
+        "debug", "fix", "error", "not working", "issue",
+        "problem", "bug", "wrong", "fail", "help with"
+    ],
+    "followup": [
+        "more", "explain more", "tell me more", "elaborate",
+        "details", "examples", "continue", "what else"
+    ],
+    "same_topic": [  # questions that keep the previous topic instead of starting a new one
+        "more", "explain", "elaborate", "details", "examples", "continue"
+    ],
+}
+INTENT_KINDS = ("code", "explanation", "comparison", "debug")  # priority order
+
+CASUAL_PATTERNS = frozenset([
+    'hi', 'hello', 'hey', 'sup', 'yo', 'hiya', 'good morning', 
+    'good afternoon', 'good evening', 'howdy', 'what\'s up', 
+    'how are you', 'how\'s it going', 'whats up', 'greetings'
+])
+
+def keyword_stem(keyword):
+    """Stem a single-word keyword matches as a prefix of (debug -> debugging, fail -> failure,
+    compare -> compared / comparison); phrases and very short words ("vs") match whole, None"""
+    if " " in keyword or len(keyword) < 3:
+        return None
+    return keyword[:-1] if keyword.endswith("e") and len(keyword) > 4 else keyword
+
+def build_intent_matcher():
+    """Compile every keyword into one alternation and map each matched phrase or stem to its categories"""
+    categories, phrases, stems = {}, set(), set()
+    for category, keywords in INTENT_KEYWORDS.items():
+        for keyword in keywords:
+            stem = keyword_stem(keyword)
+            (stems if stem else phrases).add(stem or keyword)
+            categories.setdefault(stem or keyword, set()).add(category)
+    # a phrase hides the keywords inside it ("explain more" contains "explain"), so inherit theirs
+    keyword_categories = {}
+    for key, own in categories.items():
+        merged = set(own)
+        if " " in key:
+            for other, other_categories in categories.items():
+                if other != key and re.search(rf"\b{re.escape(other)}", key):
+                    merged |= other_categories
+        keyword_categories[key] = frozenset(merged)
+
+    def alternation(keys):
+        return "|".join(re.escape(k) for k in sorted(keys, key=len, reverse=True))
+
+    # whole words or stems only (bare substrings made "prefix" a debug request); phrases are tried first
+    pattern = re.compile(rf"\b(?:({alternation(phrases)})\b|({alternation(stems)})\w*)")
+    return pattern, keyword_categories
+
+INTENT_PATTERN, KEYWORD_CATEGORIES = build_intent_matcher()
+
+Intent = namedtuple("Intent", ["kind", "is_casual", "is_followup", "new_topic"])
+
+@functools.lru_cache(maxsize=4096)
+def classify_question(text):
+    """Classify a question in a single pass, kind is code/explanation/comparison/debug/general"""
+    lowered = text.lower()
+    found = set()
+    for match in INTENT_PATTERN.finditer(lowered):
+        found |= KEYWORD_CATEGORIES[match.group(1) or match.group(2)]
+    kind = next((kind for kind in INTENT_KINDS if kind in found), "general")
+    return Intent(
+        kind=kind,
+        is_casual=lowered.strip() in CASUAL_PATTERNS,
+        is_followup="followup" in found,
+        new_topic="same_topic" not in found,
+    )
+
+# History budget (recent turns verbatim, older turns folded into a rolling summary)
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '3000'))
+CHARS_PER_TOKEN = 4  # rough estimate, good enough for budgeting
+
+def estimate_tokens(text):
+    """Cheap token estimate for budgeting history"""
+    return len(text) // CHARS_PER_TOKEN + 1
+
 # Conversation memory 
 class Conversation:
-    def __init__(self):
-        self.history = []
+    __slots__ = ("key", "store", "history", "base_seq", "last_topic", "summary", "compacting", "epoch",
+                 "size", "on_resize")
+
+    def __init__(self, key=None, store=None):
+        self.key = key
+        self.store = store  # persistent ConversationStore, None when memory only
+        self.history = []  # turns not yet folded into the summary
+        self.base_seq = 0  # sequence number of history[0]
         self.last_topic = None
+        self.summary = None  # rolling summary of older turns
+        self.compacting = False
+        self.epoch = 0  # bumped on clear so a running compaction is discarded
+        self.size = 200  # approx_size, kept up to date as the conversation changes
+        self.on_resize = None  # callback(key, size) of the store holding it in memory
 
-    def add_message(self, role, content):
+    def add_message(self, role, content, intent=None):
         # Map roles 
         mapped_role = "user" if role == "user" else "model"
         
@@ -180,170 +1136,158 @@ class Conversation:
         }
         
         self.history.append(message)
+        grown = 100 + len(content)
         
         # Store last topic 
-        if role == "user" and not any(word in content.lower() for word in [
-            "more", "explain", "elaborate", "details", "examples", "continue"
-        ]):
+        if role == "user" and (intent or classify_question(content)).new_topic:
+            grown += len(content) - len(self.last_topic or "")
             self.last_topic = content
-
-    def get_messages(self):
-        return self.history
+        self.resized(self.size + grown)
+
+        if self.store:
+            seq = self.base_seq + len(self.history) - 1
+            self.store.record_turn(self.key, seq, mapped_role, content, self.last_topic)
+
+    def fold(self, cut, summary):
+        """Replace the first cut turns with a new rolling summary"""
+        folded = sum(100 + len(msg["parts"][0]) for msg in self.history[:cut])
+        self.resized(self.size + len(summary) - len(self.summary or "") - folded)
+        self.summary = summary
+        del self.history[:cut]
+        self.base_seq += cut
+        if self.store:
+            self.store.record_summary(self.key, summary, self.base_seq)
+
+    def window_start(self, budget=HISTORY_TOKEN_BUDGET):
+        """Index of the oldest turn that still fits in the token budget"""
+        used = estimate_tokens(self.summary) if self.summary else 0
+        start = len(self.history)
+        for i in range(len(self.history) - 1, -1, -1):
+            used += estimate_tokens(self.history[i]["parts"][0])
+            if used > budget:
+                break
+            start = i
+        # start the window on a user turn so roles keep alternating
+        while start < len(self.history) and self.history[start]["role"] != "user":
+            start += 1
+        return start
+
+    def needs_compaction(self):
+        return not self.compacting and self.window_start() > 0
+
+    def get_messages(self, budget=HISTORY_TOKEN_BUDGET):
+        """History sent to gemini: rolling summary + recent turns within the budget"""
+        messages = self.history[self.window_start(budget):]
+        if self.summary:
+            return [
+                {"role": "user", "parts": [f"Summary of our earlier conversation: {self.summary}"]},
+                {"role": "model", "parts": ["Got it, I'll keep that in mind."]},
+            ] + messages
+        return messages
 
     def get_last_topic(self):
         
         return self.last_topic # Return the last topic
 
-    def clear(self):
-        self.history = []
-        self.last_topic = None
+    def approx_size(self):
+        """Rough memory footprint in bytes (text dominates)"""
+        return self.size
 
-def is_casual_chat(text): 
-    """Check if the message is a casual greeting or chat"""
-    casual_patterns = [
-        'hi', 'hello', 'hey', 'sup', 'yo', 'hiya', 'good morning', 
-        'good afternoon', 'good evening', 'howdy', 'what\'s up', 
-        'how are you', 'how\'s it going', 'whats up', 'greetings'
-    ]
-    return text.lower().strip() in casual_patterns
-
-def get_enhanced_prompt(question, style_prompt, conv): # Add more context to enchance the prompt
-    """Generate an enhanced prompt with better context and instructions"""
-    
-    # question type
-    code_keywords = [
-        "write code", "generate code", "create a program", "write a function",
-        "write a class", "implement", "code example", "write script",
-        "programming", "function to", "class that", "code for", "write", "code"
-    ]
-    
-    explanation_keywords = [
-        "explain", "how does", "what is", "why does", "describe",
-        "tell me about", "what are", "define", "elaborate"
-    ]
-    
-    comparison_keywords = [
-        "difference between", "compare", "versus", "vs",
-        "better than", "pros and cons", "advantages"
-    ]
-    
-    debug_keywords = [
-        "debug", "fix", "error", "not working", "issue",
-        "problem", "bug", "wrong", "fail", "help with"
-    ]
-
-    # Determine type
-    is_code_request = any(keyword in question.lower() for keyword in code_keywords)
-    is_explanation = any(keyword in question.lower() for keyword in explanation_keywords)
-    is_comparison = any(keyword in question.lower() for keyword in comparison_keywords)
-    is_debug = any(keyword in question.lower() for keyword in debug_keywords)
-    
-    
-    context = ""
-    last_topic = conv.get_last_topic()# Get the last topic
-    
-    if last_topic and len(conv.history) > 0:
-        context = "\nPrevious topic: " + last_topic
-        
-        last_exchanges = conv.history[-4:] if len(conv.history) >= 4 else conv.history
-        context += "\nRecent conversation:\n"
-        for msg in last_exchanges:
-            context += f"{msg['role']}: {msg['parts'][0]}\n"
+    def measure(self):
+        """Recount size after history was filled in directly (loaded from disk)"""
+        self.size = 200 + len(self.summary or "") + len(self.last_topic or "")
+        for msg in self.history:
+            self.size += 100 + len(msg["parts"][0])
 
-    
-    if is_code_request:
-        prompt = f"""Generate code based on this request: {question}
+    def resized(self, size):
+        self.size = size
+        if self.on_resize:
+            self.on_resize(self.key, size)
 
-Requirements:
-1. Write clean, efficient code
-2. Include necessary imports
-3. Add brief comments
-4. Use proper formatting
-
-Format the response as:
-```python
-# Your code here
-```
-
-Keep the code concise and focused."""
-        return prompt
-
-    elif is_explanation:
-        prompt = f"""Provide a clear and comprehensive explanation.
-
-Question: {question}
-
-Guidelines:
-- Start with a concise overview
-- Break down complex concepts
-- Use analogies when helpful
-- Provide relevant examples
-- Include practical applications
-- Address common misconceptions
-
-Previous context:{context}
-{style_prompt}"""
-
-    elif is_comparison:
-        prompt = f"""Compare and contrast the subjects thoroughly.
-
-Question: {question}
-
-Structure:
-1. Brief overview of both subjects
-2. Key differences
-3. Key similarities
-4. Pros and cons of each
-5. Common use cases
-6. Recommendation if applicable
+    def clear(self):
+        self.resized(200)
+        self.history = []
+        self.base_seq = 0
+        self.last_topic = None
+        self.summary = None
+        self.epoch += 1
+        if self.store:
+            self.store.record_clear(self.key)
+
+def build_summary_prompt(messages, previous_summary=None):
+    """Build the summary prompt shared by !summarize and history compaction"""
+    history_text = "\n".join([
+        f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['parts'][0]}" 
+        for msg in messages
+    ])
+    if previous_summary:
+        history_text = f"Earlier in the conversation: {previous_summary}\n\n{history_text}"
+
+    return f"""Please provide a brief summary of this conversation:
 
-Previous context:{context}
-{style_prompt}"""
+{history_text}
 
-    elif is_debug:
-        prompt = f"""Help debug and fix the issue.
+Focus on the main points discussed and key conclusions."""
 
-Problem: {question}
+# keep references to fire-and-forget tasks so they aren't garbage collected
+background_tasks = set()
 
-Approach:
-1. Identify potential issues
-2. Suggest solutions
-3. Explain why the problem occurs
-4. Provide corrected code if applicable
-5. Suggest preventive measures
+def schedule_compaction(conv):
+    """Fold turns that fell out of the budget into the summary, off the request path"""
+    if not conv.needs_compaction():
+        return
+    conv.compacting = True
+    task = asyncio.create_task(compact_conversation(conv))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
-Previous context:{context}
-{style_prompt}"""
+async def compact_conversation(conv):
+    """Summarize the oldest turns (down to half the budget) into conv.summary"""
+    try:
+        epoch = conv.epoch
+        cut = conv.window_start(HISTORY_TOKEN_BUDGET // 2)
+        if cut == 0:
+            return
+        prompt = build_summary_prompt(conv.history[:cut], conv.summary)
+        if not admission.try_background(estimate_tokens(prompt)):
+            return  # quota is busy with users, retried after a later turn
+        response = await generate_content_async(model_for("summarize"), prompt)
+        usage_tracker.record(None, None, "compaction", getattr(response, "usage_metadata", None))
+        summary = get_response_text(response)
+        if summary and conv.epoch == epoch:  # conversation wasn't cleared meanwhile
+            conv.fold(cut, summary)
+    except Exception as e:
+        log.warning("compacting conversation failed", extra={"fields": {"key": conv.key}}, exc_info=e)
+    finally:
+        conv.compacting = False
 
-    else:
-        # promt for general question
-        prompt = f"""Provide a helpful and informative response.
+def is_casual_chat(text): 
+    """Check if the message is a casual greeting or chat"""
+    return text.lower().strip() in CASUAL_PATTERNS
 
-Question: {question}
+def build_context(conv):
+    """Previous topic + last few turns, as injected into the prompt"""
+    last_topic = conv.get_last_topic()# Get the last topic
+    if not (last_topic and conv.history):
+        return ""
 
-Guidelines:
-- Be accurate and up-to-date
-- Include relevant examples
-- Explain any technical terms
-- Provide practical applications
-- Consider different perspectives
+    lines = ["", "Previous topic: " + last_topic, "Recent conversation:"]
+    lines.extend(f"{msg['role']}: {msg['parts'][0]}" for msg in conv.history[-4:])
+    lines.append("")
+    return "\n".join(lines)
 
-Previous context:{context}
-{style_prompt}"""
+def get_enhanced_prompt(question, style, conv, intent=None, inline_style=True): # Add more context to enchance the prompt
+    """Generate an enhanced prompt: cached static prefix for style + intent, then context and question.
 
-    # Add general response 
-    prompt += """
+    inline_style=False leaves out the style and response guidelines, for models that get them as system instruction.
+    """
+    intent = intent or classify_question(question)
+    prefix = get_prompt_prefix(style, intent.kind, inline_style)
 
-Response Guidelines:
-- Be clear and concise
-- Use markdown formatting for better readability
-- Include relevant examples
-- Cite sources if applicable
-- Maintain the specified conversation style
-- If uncertain, acknowledge limitations
-"""
+    if intent.kind == "code":
+        return f"{prefix}\n\nRequest: {question}"
 
-    return prompt
+    return f"{prefix}\n\nPrevious context:{build_context(conv)}\nQuestion: {question}"
 
 def get_response_text(response):
     """Safely extract text from Gemini response"""
@@ -374,62 +1318,1378 @@ def get_response_text(response):
                     
         return None
     except Exception as e:
-        print(f"Error extracting response text: {str(e)}")
+        log.warning("extracting response text failed", exc_info=e)
         return None
 
-def split_into_messages(text, max_length=1900):
-    """Split text into Discord-friendly chunks"""
-    messages = []
-    current_message = ""
-    
-    # Split code blocks and text
-    parts = text.split("```")
-    for i, part in enumerate(parts):
-        is_code_block = i % 2 == 1
-        
-        if is_code_block:
-            #  code blocks
-            if len(current_message) + len(part) + 6 > max_length:  # 6 for the ``` markers
-                if current_message:
-                    messages.append(current_message)
-                    current_message = ""
-                
-                # Split large code blocks
-                code_chunks = [part[i:i+max_length-8] for i in range(0, len(part), max_length-8)]
-                for chunk in code_chunks[:-1]:
-                    messages.append(f"```{chunk}```")
-                current_message = f"```{code_chunks[-1]}```" if code_chunks else ""
-            else:
-                current_message += f"```{part}```"
+# Pagination (one pass over the answer, code blocks survive page breaks, nothing is ever cut off)
+EMBED_TITLE_LIMIT = 256
+EMBED_DESCRIPTION_LIMIT = 4096
+EMBED_FIELD_LIMIT = 1024
+EMBED_MAX_FIELDS = 25
+EMBED_TOTAL_LIMIT = 6000  # per embed, and for all embeds of one message together
+MESSAGE_MAX_EMBEDS = 10
+PAGINATION = os.getenv('PAGINATION', 'messages')  # messages (as many as needed) | buttons (one message, ◀ ▶)
+PAGE_VIEW_TIMEOUT = 600  # seconds the buttons keep working
+FENCE_RE = re.compile(r"`{3,}|~{3,}")
+FENCE_LANG_MAX = 16  # language tag kept when a code block is reopened on the next page
+
+def code_fence(line):
+    """The ``` / ~~~ marker if line opens or closes a code block (```one-liners``` don't)"""
+    stripped = line.strip()
+    if not stripped.startswith(("```", "~~~")):  # cheap reject, most lines are prose
+        return None
+    marker = FENCE_RE.match(stripped).group()
+    if len(stripped) >= 2 * len(marker) and stripped.endswith(marker) and stripped != marker * 2:
+        return None
+    return marker
+
+def paginate(text, limit):
+    """Split text into pages of at most limit chars, at line breaks where possible.
+
+    A code block that spans a page break is closed at the end of the page and reopened (marker plus a short
+    language tag) at the top of the next. Lines longer than a page are cut at a space, or hard cut if there is none.
+    """
+    pages = []
+    page, size = [], -1  # lines of the page being built, their length joined with newlines
+    fence = None  # (header to reopen with, marker) of the code block we're in
+
+    def flush():
+        nonlocal page, size
+        if fence:
+            page.append(fence[1])
+        pages.append("\n".join(page))
+        page = [fence[0]] if fence else []
+        size = len(fence[0]) if fence else -1
+
+    for line in text.split("\n"):
+        marker = code_fence(line)
+        after = fence
+        if marker and fence is None:
+            lang = line.strip()[len(marker):].split(maxsplit=1)
+            header = marker + (lang[0][:FENCE_LANG_MAX] if lang else "")
+            if len(header) + len(marker) + 2 <= limit // 2:  # absurd markers are just text, a reopened page must have room
+                after = (header, marker)
+        elif marker and marker.startswith(fence[1]):
+            after = None
+        reserve = len(after[1]) + 1 if after else 0  # room to close the block if the page ends here
+
+        if size + 1 + len(line) + reserve > limit and page and size > (len(fence[0]) if fence else -1):
+            flush()
+        fence = fence or after  # an opening line too long for one page is cut inside its own block
+        while size + 1 + len(line) + reserve > limit:
+            room = limit - size - 1 - (len(fence[1]) + 1 if fence else 0)  # >= 1, headers are at most limit // 2
+            cut = line.rfind(" ", 0, room)
+            cut = cut + 1 if cut > room // 2 else room
+            page.append(line[:cut])
+            size += 1 + cut
+            line = line[cut:]
+            flush()
+        page.append(line)
+        size += 1 + len(line)
+        fence = after
+
+    if page:
+        pages.append("\n".join(page))
+    return [page for page in pages if page.strip()]
+
+def markdown_sections(text):
+    """Split an answer into ("text", ...) and ("code", "```lang ... ```") sections in one pass"""
+    sections, lines = [], []
+    fence = None
+    for line in text.split("\n"):
+        marker = code_fence(line)
+        if marker and fence is None:
+            if lines:
+                sections.append(("text", "\n".join(lines)))
+            lines, fence = [line], marker
+        elif marker and marker.startswith(fence):
+            lines.append(line)
+            sections.append(("code", "\n".join(lines)))
+            lines, fence = [], None
         else:
-            # regular text
-            sentences = part.split('. ')
-            for sentence in sentences:
-                if sentence:
-                    if len(current_message) + len(sentence) + 2 > max_length:
-                        messages.append(current_message.strip())
-                        current_message = sentence + '. '
-                    else:
-                        current_message += sentence + '. '
-    
-    if current_message:
-        messages.append(current_message.strip())
-    
-    return messages
+            lines.append(line)
+    if lines:
+        sections.append(("code" if fence else "text", "\n".join(lines)))
+    return [(kind, body.strip()) for kind, body in sections if body.strip()]
+
+class EmbedPager:
+    """Fills embeds up to discord's limits, continuing in a new embed instead of cutting anything"""
+    def __init__(self, title, color):
+        self.title = title[:EMBED_TITLE_LIMIT]
+        self.color = color
+        self.embeds = []
+        self.new_embed()
+
+    def new_embed(self):
+        title = self.title if not self.embeds else f"{self.title} (cont. {len(self.embeds) + 1})"[-EMBED_TITLE_LIMIT:]
+        self.embed = discord.Embed(title=title, color=self.color)
+        self.embeds.append(self.embed)
+
+    def add_description(self, text):
+        for page in paginate(text, EMBED_DESCRIPTION_LIMIT):
+            if self.embed.description or self.embed.fields or len(self.embed) + len(page) > EMBED_TOTAL_LIMIT:
+                self.new_embed()
+            self.embed.description = page
+
+    def add_field(self, name, text):
+        pages = paginate(text, EMBED_FIELD_LIMIT)
+        for i, page in enumerate(pages):
+            field_name = f"{name} Part {i + 1}" if len(pages) > 1 else name
+            if len(self.embed.fields) >= EMBED_MAX_FIELDS or len(self.embed) + len(field_name) + len(page) > EMBED_TOTAL_LIMIT:
+                self.new_embed()
+            self.embed.add_field(name=field_name, value=page, inline=False)
+
+def group_embeds(embeds):
+    """Pack embeds into as few messages as possible (10 embeds / 6000 chars per message)"""
+    groups, group, size = [], [], 0
+    for embed in embeds:
+        if group and (len(group) >= MESSAGE_MAX_EMBEDS or size + len(embed) > EMBED_TOTAL_LIMIT):
+            groups.append(group)
+            group, size = [], 0
+        group.append(embed)
+        size += len(embed)
+    if group:
+        groups.append(group)
+    return groups
+
+class PageView(discord.ui.View):
+    """◀ ▶ buttons flipping through the pages of one answer (only for whoever asked)"""
+    def __init__(self, embeds, author_id):
+        super().__init__(timeout=PAGE_VIEW_TIMEOUT)
+        self.embeds = embeds
+        self.author_id = author_id
+        self.page = 0
+        self.message = None
+        for i, embed in enumerate(embeds):
+            embed.set_footer(text=f"Page {i + 1}/{len(embeds)}")
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page == len(self.embeds) - 1
+
+    async def interaction_check(self, interaction):
+        return interaction.user.id == self.author_id
+
+    async def show(self, interaction, page):
+        self.page = page
+        self.update_buttons()
+        await interaction.response.edit_message(embed=self.embeds[page], view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self.show(interaction, self.page + 1)
+
+    async def on_timeout(self):
+        if self.message:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
+
+async def send_embeds(ctx, embeds):
+    """Send all pages, packed into as few messages as possible or as one message with page buttons"""
+    if PAGINATION == "buttons" and len(embeds) > 1:
+        view = PageView(embeds, ctx.author.id)
+        view.message = await ctx.send(embed=embeds[0], view=view)
+        return
+    for group in group_embeds(embeds):
+        if len(group) == 1:
+            await ctx.send(embed=group[0])
+        else:
+            await ctx.send(embeds=group)
+
+# Streaming (edit one message in place while gemini is still typing)
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') == '1'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.2'))  # discord allows ~5 edits / 5s per channel
+
+async def stream_response(ctx, chunks, title):
+    """Post a placeholder embed and edit it as chunks arrive, rolling over into follow-up messages.
+
+    Returns (text, usage_metadata of the last chunk that had one).
+    """
+    loop = asyncio.get_running_loop()
+    placeholder = discord.Embed(title=title, description="✍️ Thinking...", color=discord.Color.blue())
+    messages = [await ctx.send(embed=placeholder)]
+    shown = [None]  # page text currently displayed in each message
+    parts = []
+    usage = None
+    last_edit = loop.time()
+
+    async def flush():
+        pages = paginate("".join(parts).strip(), EMBED_DESCRIPTION_LIMIT)
+        for i, page in enumerate(pages):
+            if not page or (i < len(shown) and shown[i] == page):
+                continue
+            embed = discord.Embed(
+                title=title if i == 0 else f"{title} (cont. {i + 1})",
+                description=page,
+                color=discord.Color.blue()
+            )
+            if i < len(messages):
+                await messages[i].edit(embed=embed)
+                shown[i] = page
+            else:
+                messages.append(await ctx.send(embed=embed))
+                shown.append(page)
+
+    started = time.perf_counter()
+    async for chunk in chunks:
+        usage = getattr(chunk, "usage_metadata", None) or usage
+        try:
+            piece = chunk.text
+        except ValueError:  # chunk without text parts (finish reason / safety only)
+            continue
+        if not piece:
+            continue
+        if not parts:
+            metrics.observe("bot_ask_phase_seconds", time.perf_counter() - started, phase="first_token")
+        parts.append(piece)
+        if loop.time() - last_edit >= STREAM_EDIT_INTERVAL:
+            await flush()
+            last_edit = loop.time()
+
+    response_text = "".join(parts).strip()
+    if not response_text:
+        await messages[0].delete()
+        return None, usage
+    await flush()
+    return response_text, usage
+
+# Bounded stores (the bot lives for weeks in many guilds, nothing may grow forever)
+CONVERSATION_MAX_ENTRIES = int(os.getenv('CONVERSATION_MAX_ENTRIES', '10000'))
+CONVERSATION_IDLE_TTL = float(os.getenv('CONVERSATION_IDLE_TTL', str(6 * 3600)))  # seconds
+CONVERSATION_MAX_BYTES = int(os.getenv('CONVERSATION_MAX_BYTES', str(256 * 1024 * 1024)))
+class LRUStore:
+    """Map with LRU + idle-TTL eviction, an entry cap and an estimated memory ceiling (factory gets the key).
+
+    Sizes are tracked per entry, values that grow report it through resize() so the ceiling holds without rescans.
+    """
+    def __init__(self, factory, max_entries, ttl, max_bytes=None, size_of=None):
+        self.factory = factory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.entries = OrderedDict()  # key -> [last_access, value, size], oldest access first
+        self.estimated_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """Return the value for key, creating it with factory() on a miss"""
+        value = self.lookup(key)
+        if value is None:
+            value = self.insert(key, self.factory(key))
+        return value
+
+    def lookup(self, key):
+        """Return the value for key, None on a miss (nothing is created)"""
+        now = time.monotonic()
+        self.expire(now)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        entry[0] = now
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def insert(self, key, value):
+        """Add a value created elsewhere, evicting as needed"""
+        self.remove(key)
+        size = self.size_of(value) if self.size_of else 0
+        self.entries[key] = [time.monotonic(), value, size]
+        self.estimated_bytes += size
+        while len(self.entries) > self.max_entries:
+            self.evict()
+        self.enforce_memory()
+        return value
+
+    def resize(self, key, size):
+        """An entry's value changed size, evict others if that crosses the ceiling"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        self.estimated_bytes += size - entry[2]
+        entry[2] = size
+        self.entries.move_to_end(key)  # growing means it's in use
+        self.enforce_memory()
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.estimated_bytes -= entry[2]
+        return entry
+
+    def pop(self, key):
+        entry = self.remove(key)
+        return entry[1] if entry else None
+
+    def evict(self):
+        _, entry = self.entries.popitem(last=False)
+        self.estimated_bytes -= entry[2]
+        self.evictions += 1
+
+    def expire(self, now=None):
+        """Drop entries idle longer than ttl (they sit at the front of the LRU order)"""
+        now = time.monotonic() if now is None else now
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if now - entry[0] <= self.ttl:
+                break
+            self.remove(key)
+            self.expirations += 1
+
+    def enforce_memory(self):
+        """Evict least recently used entries until under max_bytes (the newest one always stays)"""
+        while self.max_bytes and self.estimated_bytes > self.max_bytes and len(self.entries) > 1:
+            self.evict()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "estimated_bytes": self.estimated_bytes,
+        }
 
-# Store conversation
-conversations = {}
+class RecentIds:
+    """Fixed-size, time-windowed set of recently seen ids"""
+    def __init__(self, maxlen, window):
+        self.maxlen = maxlen
+        self.window = window
+        self.order = deque()  # (seen_at, id), oldest first
+        self.ids = set()
+
+    def add(self, item):
+        """Remember item, returns False if it was already seen in the window"""
+        now = time.monotonic()
+        while self.order and (now - self.order[0][0] > self.window or len(self.order) >= self.maxlen):
+            self.ids.discard(self.order.popleft()[1])
+        if item in self.ids:
+            return False
+        self.order.append((now, item))
+        self.ids.add(item)
+        return True
+
+# Conversation stores (get_conversation goes through one of these)
+CONVERSATION_BACKEND = os.getenv('CONVERSATION_BACKEND', 'memory')  # memory | sqlite
+CONVERSATION_DB = os.getenv('CONVERSATION_DB', os.path.join(BOT_DIR, 'conversations.db'))
+
+class ConversationStore:
+    """Interface for conversation storage"""
+    async def get(self, key):
+        """Return the Conversation for key, creating or loading it if needed"""
+        raise NotImplementedError
+
+    def record_turn(self, key, seq, role, content, last_topic):
+        pass
+
+    def record_summary(self, key, summary, base_seq):
+        pass
+
+    def record_clear(self, key):
+        pass
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {}
 
-def get_conversation(user_id, channel_id): # Get conversation
+class MemoryConversationStore(ConversationStore):
+    """Process-local conversations, lost on restart"""
+    def __init__(self):
+        self.cache = LRUStore(
+            self.create,
+            max_entries=CONVERSATION_MAX_ENTRIES,
+            ttl=CONVERSATION_IDLE_TTL,
+            max_bytes=CONVERSATION_MAX_BYTES,
+            size_of=Conversation.approx_size,
+        )
+
+    def create(self, key):
+        conv = Conversation(key)
+        conv.on_resize = self.cache.resize
+        return conv
+
+    async def get(self, key):
+        return self.cache.get(key)
+
+    def stats(self):
+        return self.cache.stats()
+
+class SQLiteConversationStore(WriteBehind, ConversationStore):
+    """SQLite (WAL) backed conversations: lazy loads, appends turns with write-behind batches"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            key TEXT PRIMARY KEY,
+            summary TEXT,
+            base_seq INTEGER NOT NULL DEFAULT 0,
+            last_topic TEXT
+        );
+        CREATE TABLE IF NOT EXISTS turns (
+            key TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            PRIMARY KEY (key, seq)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # in-memory cache of loaded conversations, evicted ones are reloaded from disk
+        self.cache = LRUStore(
+            None,  # misses are loaded by get() in a worker thread
+            max_entries=CONVERSATION_MAX_ENTRIES,
+            ttl=CONVERSATION_IDLE_TTL,
+            max_bytes=CONVERSATION_MAX_BYTES,
+            size_of=Conversation.approx_size,
+        )
+        self.reader = self.connect()  # used by lazy loads in worker threads
+        self.read_lock = threading.Lock()  # one load at a time on the reader connection
+        self.writer = None  # used by the flush thread
+        self.pending = []  # queued write ops, in order
+        self.inflight = []  # ops currently being written
+        self.rows_written = 0
+        self.init_write_behind()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)  # shard workers share the file
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(self.SCHEMA)
+        return db
+
+    async def get(self, key):
+        conv = self.cache.lookup(key)
+        if conv is not None:
+            return conv
+        ops = [op for op in self.inflight + self.pending if op[1] == key]  # not on disk when the read starts
+        conv = await asyncio.to_thread(self.load, key)
+        if key in self.cache:  # loaded by another command meanwhile, theirs may already have new turns
+            return self.cache.lookup(key)
+        for op in ops:
+            self.replay(conv, op)
+        conv.measure()
+        conv.store = self  # attach last so the replay isn't recorded again
+        conv.on_resize = self.cache.resize
+        return self.cache.insert(key, conv)
+
+    def load(self, key):
+        """Read a conversation from disk (runs in a worker thread), get() adds writes that aren't flushed yet"""
+        conv = Conversation(key)
+        with self.read_lock:
+            row = self.reader.execute(
+                "SELECT summary, base_seq, last_topic FROM conversations WHERE key = ?", (key,)
+            ).fetchone()
+            if row:
+                conv.summary, conv.base_seq, conv.last_topic = row
+            for role, content in self.reader.execute(
+                "SELECT role, content FROM turns WHERE key = ? AND seq >= ? ORDER BY seq", (key, conv.base_seq)
+            ):
+                conv.history.append({"role": role, "parts": [content]})
+        return conv
+
+    @staticmethod
+    def replay(conv, op):
+        kind = op[0]
+        if kind == "turn":
+            _, _, seq, role, content, last_topic = op
+            if seq == conv.base_seq + len(conv.history):  # skip turns already read from disk
+                conv.history.append({"role": role, "parts": [content]})
+                conv.last_topic = last_topic
+        elif kind == "summary":
+            _, _, summary, base_seq = op
+            del conv.history[:max(0, base_seq - conv.base_seq)]
+            conv.summary, conv.base_seq = summary, base_seq
+        elif kind == "clear":
+            conv.history, conv.base_seq, conv.summary, conv.last_topic = [], 0, None, None
+
+    def queue(self, op):
+        self.pending.append(op)
+        if len(self.pending) >= STORE_FLUSH_BATCH:
+            self.flush_wanted.set()
+
+    def record_turn(self, key, seq, role, content, last_topic):
+        self.queue(("turn", key, seq, role, content, last_topic))
+
+    def record_summary(self, key, summary, base_seq):
+        self.queue(("summary", key, summary, base_seq))
+
+    def record_clear(self, key):
+        self.queue(("clear", key))
+
+    def write_batch(self, ops):
+        """Apply queued ops in one transaction (runs in a worker thread)"""
+        if self.writer is None:
+            self.writer = self.connect()
+        with self.writer:
+            for op in ops:
+                kind, key = op[0], op[1]
+                if kind == "turn":
+                    _, _, seq, role, content, last_topic = op
+                    self.writer.execute(
+                        "INSERT OR REPLACE INTO turns (key, seq, role, content) VALUES (?, ?, ?, ?)",
+                        (key, seq, role, content)
+                    )
+                    self.writer.execute(
+                        "INSERT INTO conversations (key, last_topic) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET last_topic = excluded.last_topic",
+                        (key, last_topic)
+                    )
+                elif kind == "summary":
+                    _, _, summary, base_seq = op
+                    self.writer.execute(
+                        "INSERT INTO conversations (key, summary, base_seq) VALUES (?, ?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET summary = excluded.summary, base_seq = excluded.base_seq",
+                        (key, summary, base_seq)
+                    )
+                    self.writer.execute("DELETE FROM turns WHERE key = ? AND seq < ?", (key, base_seq))
+                elif kind == "clear":
+                    self.writer.execute("DELETE FROM turns WHERE key = ?", (key,))
+                    self.writer.execute("DELETE FROM conversations WHERE key = ?", (key,))
+
+    async def flush(self):
+        if not self.pending or self.inflight:
+            return
+        self.inflight, self.pending = self.pending, []
+        try:
+            await asyncio.to_thread(self.write_batch, self.inflight)
+            self.flushes += 1
+            self.rows_written += len(self.inflight)
+        except Exception as e:
+            log.warning("flushing conversations failed, retrying next flush",
+                        extra={"fields": {"ops": len(self.inflight)}}, exc_info=e)
+            self.pending = self.inflight + self.pending  # retry next round
+        finally:
+            self.inflight = []
+
+    async def close(self):
+        await self.stop_flushing()  # waits for a running batch, then writes the rest
+        if self.pending:
+            log.warning("conversation writes lost on shutdown", extra={"fields": {"ops": len(self.pending)}})
+        self.reader.close()
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats.update(pending_writes=len(self.pending), flushes=self.flushes, rows_written=self.rows_written)
+        return stats
+
+def make_conversation_store():
+    if CONVERSATION_BACKEND == 'sqlite':
+        return SQLiteConversationStore(CONVERSATION_DB)
+    return MemoryConversationStore()
+
+conversation_store = make_conversation_store()
+
+async def get_conversation(user_id, channel_id): # Get conversation
     key = f"{user_id}_{channel_id}"# Key
-    if key not in conversations:
-        conversations[key] = Conversation()
-    return conversations[key]
+    return await conversation_store.get(key)
+
+# Rate limiting / admission control (per user and guild reject fast, the global gemini quota queues fairly)
+RATE_LIMIT_USER_RPM = float(os.getenv('RATE_LIMIT_USER_RPM', '6'))
+RATE_LIMIT_GUILD_RPM = float(os.getenv('RATE_LIMIT_GUILD_RPM', '30'))
+# match the project's gemini quota, split evenly between shard workers
+GEMINI_RPM = float(os.getenv('GEMINI_RPM', '60')) / SHARD_WORKERS
+GEMINI_TPM = float(os.getenv('GEMINI_TPM', '120000')) / SHARD_WORKERS
+ADMISSION_QUEUE_LIMIT = int(os.getenv('ADMISSION_QUEUE_LIMIT', '50'))
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at rate tokens/second"""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, amount=1):
+        self.refill()
+        amount = min(amount, self.capacity)  # a huge request still gets through eventually
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def wait_time(self, amount=1):
+        self.refill()
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def refund(self, amount=1):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+class RateLimited(Exception):
+    """Request rejected by admission control"""
+    def __init__(self, scope, retry_after):
+        super().__init__(f"{scope} rate limit, retry after {retry_after:.1f}s")
+        self.scope = scope  # user | guild | global
+        self.retry_after = retry_after
+
+    @property
+    def user_message(self):
+        wait = max(1, round(self.retry_after))
+        if self.scope == "user":
+            return f"⏳ Slow down! You can ask again in {wait}s."
+        if self.scope == "guild":
+            return f"⏳ This server is sending too many requests, try again in {wait}s."
+        return f"⏳ I'm at capacity right now, please try again in {wait}s."
+
+class AdmissionController:
+    """Token buckets per user, per guild and for the global RPM/TPM, with a FIFO queue for the global limit.
+
+    Each user may have one request waiting in the queue, everything else over a limit is rejected fast.
+    """
+    def __init__(self):
+        self.users = LRUStore(lambda key: TokenBucket(RATE_LIMIT_USER_RPM), max_entries=100000, ttl=3600)
+        self.guilds = LRUStore(lambda key: TokenBucket(RATE_LIMIT_GUILD_RPM), max_entries=100000, ttl=3600)
+        self.requests = TokenBucket(GEMINI_RPM)
+        self.tokens = TokenBucket(GEMINI_TPM)
+        self.queue = deque()  # (future, user_id, tokens), oldest first
+        self.queued_users = set()
+        self.pump_task = None
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.background = 0
+        self.deferred = 0
+
+    def eta(self, position):
+        """Rough seconds until the request at position (1 = head) gets through"""
+        return self.requests.wait_time(1) + (position - 1) * 60 / GEMINI_RPM
+
+    async def admit(self, user_id, guild_id, est_tokens, on_queued=None):
+        """Wait until the request may call gemini, raises RateLimited if it may not.
+
+        on_queued(position, eta) is awaited when the request has to wait in line.
+        """
+        user_bucket = self.users.get(user_id)
+        if not user_bucket.try_take():
+            self.rejected += 1
+            raise RateLimited("user", user_bucket.wait_time())
+        guild_bucket = self.guilds.get(guild_id) if guild_id else None
+        if guild_bucket and not guild_bucket.try_take():
+            user_bucket.refund()
+            self.rejected += 1
+            raise RateLimited("guild", guild_bucket.wait_time())
+
+        if not self.queue and self.requests.try_take():
+            if self.tokens.try_take(est_tokens):
+                self.admitted += 1
+                return
+            self.requests.refund()
+
+        if len(self.queue) >= ADMISSION_QUEUE_LIMIT or user_id in self.queued_users:
+            user_bucket.refund()
+            if guild_bucket:
+                guild_bucket.refund()
+            self.rejected += 1
+            raise RateLimited("global", self.eta(len(self.queue) + 1))
+
+        future = asyncio.get_running_loop().create_future()
+        self.queue.append((future, user_id, est_tokens))
+        self.queued_users.add(user_id)
+        self.queued += 1
+        if self.pump_task is None or self.pump_task.done():
+            self.pump_task = asyncio.create_task(self.pump())
+        if on_queued:
+            await on_queued(len(self.queue), self.eta(len(self.queue)))
+        await future
+
+    def try_background(self, est_tokens):
+        """Take global quota for background work (compaction), only when no user is waiting and it's free right now"""
+        if not self.queue and self.requests.try_take():
+            if self.tokens.try_take(est_tokens):
+                self.background += 1
+                return True
+            self.requests.refund()
+        self.deferred += 1
+        return False
+
+    async def pump(self):
+        """Release queued requests in order as the global buckets refill"""
+        while self.queue:
+            future, user_id, est_tokens = self.queue[0]
+            if future.done():  # caller gave up
+                self.queue.popleft()
+                self.queued_users.discard(user_id)
+                continue
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(est_tokens))
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            self.requests.try_take()
+            self.tokens.try_take(est_tokens)
+            self.queue.popleft()
+            self.queued_users.discard(user_id)
+            self.admitted += 1
+            future.set_result(None)
+
+    def stats(self):
+        return {
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "queue_depth": len(self.queue),
+            "background": self.background,
+            "deferred": self.deferred,
+        }
+
+admission = AdmissionController()
+
+async def admit_request(ctx, est_tokens):
+    """Run admission control for a command, tells the user if they're queued.
+
+    Returns False (after telling the user why) when the request was rejected.
+    """
+    async def on_queued(position, eta):
+        await ctx.send(f"⏳ Busy right now, you're #{position} in line (~{max(1, round(eta))}s).")
+
+    try:
+        await admission.admit(ctx.author.id, ctx.guild.id if ctx.guild else None, est_tokens, on_queued)
+        return True
+    except RateLimited as e:
+        await ctx.send(e.user_message)
+        return False
+
+# Priority lanes (each kind of command gets its own concurrency cap and waiting line, so a flood of
+# image analyses fills the vision lane and nothing else; local commands never wait behind gemini)
+LANE_DEFAULTS = {  # lane: (concurrency, queue limit)
+    "local": (32, 256),
+    "text": (12, 50),
+    "vision": (3, 10),
+    "summary": (2, 10),
+}
+COMMAND_LANES = {"ask": "text", "analyze": "vision", "summarize": "summary"}  # everything else is local
+
+class LaneFull(Exception):
+    """The lane's waiting line is full"""
+    def __init__(self, lane):
+        super().__init__(f"{lane} lane is full")
+        self.lane = lane
+
+    @property
+    def user_message(self):
+        kind = {"vision": "image", "summary": "summary", "text": "chat"}.get(self.lane, "")
+        return f"⏳ Too many {kind} requests right now, please try again in a moment."
+
+class Lane:
+    """At most concurrency commands run at once, up to queue_limit more wait, the rest are turned away"""
+    def __init__(self, name, concurrency, queue_limit):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.running = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        if self.semaphore.locked() and self.waiting >= self.queue_limit:
+            self.rejected += 1
+            raise LaneFull(self.name)
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        metrics.observe("bot_lane_wait_seconds", time.perf_counter() - start, lane=self.name)
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self.semaphore.release()
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+lanes = {
+    name: Lane(
+        name,
+        int(os.getenv(f'LANE_{name.upper()}_CONCURRENCY', str(concurrency))),
+        int(os.getenv(f'LANE_{name.upper()}_QUEUE', str(queue_limit))),
+    )
+    for name, (concurrency, queue_limit) in LANE_DEFAULTS.items()
+}
 
-# Message history prevent dup :v (hmmm maybe bug i dont know)
-message_history = {}
+def command_lane(ctx):
+    """Lane a command runs in, !ask with images counts as vision"""
+    lane = COMMAND_LANES.get(ctx.command.qualified_name if ctx.command else None, "local")
+    if lane == "text" and ctx.message.attachments:
+        return "vision"
+    return lane
+
+def lane_stats():
+    return {name: lane.stats() for name, lane in lanes.items()}
+
+async def shed_request(ctx, error):
+    """Turn a command away because its lane is full, logged and counted like every other command"""
+    ctx.command_failed = True
+    ctx.shed_by = error.lane
+    metrics.inc("bot_command_errors_total", command=ctx.command.qualified_name, error=type(error).__name__)
+    await ctx.send(error.user_message)
+
+# Token accounting + daily budgets (degrade gracefully before rejecting)
+DAILY_TOKEN_BUDGET_USER = int(os.getenv('DAILY_TOKEN_BUDGET_USER', '200000'))
+DAILY_TOKEN_BUDGET_GUILD = int(os.getenv('DAILY_TOKEN_BUDGET_GUILD', '2000000'))
+BUDGET_MODEL = os.getenv('BUDGET_MODEL', 'gemini-1.5-flash')  # cheaper model used near the budget
+BUDGET_MAX_TOKENS = 500  # output cap near the budget
+
+# (fraction of the daily budget used, what changes): history -> output length -> cheaper model -> reject
+BudgetPlan = namedtuple("BudgetPlan", ["level", "history_budget", "max_tokens_cap", "model_name"])
+BUDGET_LEVELS = [
+    (1.0, BudgetPlan(4, 0, 0, None)),
+    (0.9, BudgetPlan(3, HISTORY_TOKEN_BUDGET // 2, BUDGET_MAX_TOKENS, BUDGET_MODEL)),
+    (0.75, BudgetPlan(2, HISTORY_TOKEN_BUDGET // 2, BUDGET_MAX_TOKENS, None)),
+    (0.5, BudgetPlan(1, HISTORY_TOKEN_BUDGET // 2, None, None)),
+]
+FULL_BUDGET = BudgetPlan(0, HISTORY_TOKEN_BUDGET, None, None)
+
+class UsageTracker:
+    """Today's (UTC) gemini token usage per user, guild and command"""
+    def __init__(self):
+        self.day = None
+        self.reset_if_new_day()
+
+    def reset_if_new_day(self):
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        if today != self.day:
+            self.day = today
+            # key -> [requests, prompt tokens, output tokens]
+            self.users = defaultdict(lambda: [0, 0, 0])
+            self.guilds = defaultdict(lambda: [0, 0, 0])
+            self.commands = defaultdict(lambda: [0, 0, 0])
+
+    def record(self, user_id, guild_id, command, usage):
+        """Add a response's usage_metadata"""
+        if usage is None:
+            return
+        self.reset_if_new_day()
+        prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+        output_tokens = getattr(usage, "candidates_token_count", 0) or 0
+        buckets = [self.commands[command]]
+        if user_id:
+            buckets.append(self.users[user_id])
+        if guild_id:
+            buckets.append(self.guilds[guild_id])
+        for bucket in buckets:
+            bucket[0] += 1
+            bucket[1] += prompt_tokens
+            bucket[2] += output_tokens
+
+    def used(self, table, key):
+        self.reset_if_new_day()
+        entry = table.get(key)
+        return entry[1] + entry[2] if entry else 0
+
+    def plan(self, user_id, guild_id):
+        """How much this user/guild may spend on the next request"""
+        fraction = self.used(self.users, user_id) / DAILY_TOKEN_BUDGET_USER
+        if guild_id:
+            fraction = max(fraction, self.used(self.guilds, guild_id) / DAILY_TOKEN_BUDGET_GUILD)
+        for threshold, plan in BUDGET_LEVELS:
+            if fraction >= threshold:
+                return plan
+        return FULL_BUDGET
+
+    def top(self, table, limit=5):
+        self.reset_if_new_day()
+        return sorted(table.items(), key=lambda item: item[1][1] + item[1][2], reverse=True)[:limit]
+
+usage_tracker = UsageTracker()
+
+def record_usage(ctx, command, response):
+    usage_tracker.record(ctx.author.id, ctx.guild.id if ctx.guild else None, command,
+                         getattr(response, "usage_metadata", None))
+
+async def check_budget(ctx):
+    """Budget plan for this request, None (after telling the user) when today's budget is spent"""
+    plan = usage_tracker.plan(ctx.author.id, ctx.guild.id if ctx.guild else None)
+    if plan.level >= 4:
+        await ctx.send("❌ Daily usage limit reached, please try again tomorrow.")
+        return None
+    return plan
+
+# Model routing (small talk, short-answer styles and busy periods go to the fast model, code / debugging /
+# long prompts to the strong one). ROUTES_FILE can change the defaults and override them per guild.
+ROUTES_FILE = os.getenv('ROUTES_FILE', os.path.join(BOT_DIR, 'routes.json'))
+DEFAULT_ROUTING = {
+    "mode": os.getenv('MODEL_ROUTING', 'auto'),  # auto | fast | strong
+    "fast_model": os.getenv('FAST_MODEL', 'gemini-1.5-flash'),
+    "strong_model": MODEL_NAMES["ask"],
+    "fast_styles": ["concise", "simple"],
+    "casual_max_tokens": 300,  # output cap for greetings / small talk
+    "long_prompt_tokens": 1500,  # prompt + history at least this long -> strong model
+    "load_threshold": 0.75,  # text lane this busy (running + waiting vs. its cap) -> fast model
+}
+Route = namedtuple("Route", ["name", "model_name", "max_tokens"])
+routing = {}
+
+ROUTING_MODES = ("auto", "fast", "strong")
+
+def check_routing(config, where):
+    """Raise ValueError unless config is a valid (complete) routing section"""
+    unknown = set(config) - set(DEFAULT_ROUTING)
+    if unknown:
+        raise ValueError(f"{where}: unknown keys {', '.join(sorted(map(str, unknown)))}")
+    if config["mode"] not in ROUTING_MODES:
+        raise ValueError(f"{where}: mode must be one of {', '.join(ROUTING_MODES)}, not {config['mode']!r}")
+    for key in ("fast_model", "strong_model"):
+        if not isinstance(config[key], str) or not config[key]:
+            raise ValueError(f"{where}: {key} must be a model name")
+    if not isinstance(config["fast_styles"], list) or not all(isinstance(style, str) for style in config["fast_styles"]):
+        raise ValueError(f"{where}: fast_styles must be a list of style names")
+    for key in ("casual_max_tokens", "long_prompt_tokens", "load_threshold"):
+        if isinstance(config[key], bool) or not isinstance(config[key], (int, float)) or config[key] < 0:
+            raise ValueError(f"{where}: {key} must be a non-negative number")
+
+def routes_section(value, where):
+    if not isinstance(value, dict):
+        raise ValueError(f"{where} must be an object")
+    return value
+
+def load_routes():
+    """Load ROUTES_FILE: {"default": {...}, "guilds": {guild_id: {...}}, "prices": {model: [in, out]}}.
+
+    Guild entries only need the keys they change, prices are USD per million prompt / output tokens.
+    Raises ValueError (and keeps the current routing) when the file is invalid.
+    """
+    try:
+        with open(ROUTES_FILE, 'r') as f:
+            overrides = json.load(f)
+    except FileNotFoundError:
+        overrides = {}
+    routes_section(overrides, "routes")
+
+    default = {**DEFAULT_ROUTING, **routes_section(overrides.get("default", {}), "default")}
+    check_routing(default, "default")
+    guilds = {}
+    for guild_id, config in routes_section(overrides.get("guilds", {}), "guilds").items():
+        guilds[str(guild_id)] = {**default, **routes_section(config, f"guild {guild_id}")}
+        check_routing(guilds[str(guild_id)], f"guild {guild_id}")
+    prices = routes_section(overrides.get("prices", {}), "prices")
+    for model, price in prices.items():
+        if (not isinstance(price, list) or len(price) != 2
+                or not all(isinstance(p, (int, float)) and not isinstance(p, bool) for p in price)):
+            raise ValueError(f"prices: {model} must be [prompt, output] USD per million tokens")
+    routing.update(default=default, guilds=guilds, prices=prices)
+
+load_routes()
+
+def text_load():
+    """How busy the text lane is, 1.0 = every slot taken"""
+    lane = lanes["text"]
+    return (lane.running + lane.waiting) / lane.concurrency
+
+def route_request(intent, style, prompt_tokens, max_tokens, plan, guild_id):
+    """Pick the model and output cap for a text request"""
+    config = routing["guilds"].get(str(guild_id), routing["default"])
+    max_tokens = min(max_tokens, plan.max_tokens_cap or max_tokens)
+    if plan.model_name:  # near the daily budget, the budget plan decides
+        return Route("budget", plan.model_name, max_tokens)
+    if config["mode"] == "fast":
+        return Route("guild_fast", config["fast_model"], max_tokens)
+    if config["mode"] == "strong":
+        return Route("guild_strong", config["strong_model"], max_tokens)
+    if intent.is_casual:
+        return Route("casual", config["fast_model"], min(max_tokens, config["casual_max_tokens"]))
+    if intent.kind in ("code", "debug") or prompt_tokens >= config["long_prompt_tokens"]:
+        return Route("strong", config["strong_model"], max_tokens)
+    if text_load() >= config["load_threshold"]:
+        return Route("load", config["fast_model"], max_tokens)
+    if style in config["fast_styles"]:
+        return Route("fast_style", config["fast_model"], max_tokens)
+    return Route("default", config["strong_model"], max_tokens)
+
+def record_route(route, seconds, usage):
+    """Latency, tokens and (with prices configured) cost per route"""
+    labels = dict(route=route.name, model=route.model_name)
+    metrics.inc("bot_route_requests_total", **labels)
+    metrics.observe("bot_route_seconds", seconds, **labels)
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    output_tokens = getattr(usage, "candidates_token_count", 0) or 0
+    metrics.inc("bot_route_tokens_total", prompt_tokens + output_tokens, **labels)
+    price = routing["prices"].get(route.model_name)
+    if price:
+        metrics.inc("bot_route_cost_usd_total", (prompt_tokens * price[0] + output_tokens * price[1]) / 1e6, **labels)
+
+# Message history prevent dup (discord can redeliver a message on reconnect)
+message_history = RecentIds(maxlen=4096, window=600)
+
+# Response cache (same context-free question + style + config -> reuse the answer)
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE', '1') == '1'
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))  # seconds
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(8 * 1024 * 1024)))
+
+class ResponseCache:
+    """LRU + TTL cache of answer text, capped by total bytes"""
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (expires_at, text, size)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bypasses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self.remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, text):
+        size = len(text.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        self.remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, text, size)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            old_key = next(iter(self.entries))
+            self.remove(old_key)
+            self.evictions += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.total_bytes -= entry[2]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "bypasses": self.bypasses,
+        }
 
-def get_response_title(question, style):
+response_cache = ResponseCache(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES)
+
+def normalize_question(question):
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+def response_cache_key(question, settings, route):
+    """Cache key: the question plus everything that shapes the answer (style, config, routed model and cap)"""
+    style_config = get_style_config(settings["style"])
+    return (
+        normalize_question(question),
+        settings["style"],
+        settings["language"],
+        style_config["temperature"],
+        style_config["top_p"],
+        route.model_name,
+        route.max_tokens,
+    )
+
+# Attachment pipeline (validate from metadata, download concurrently, shrink, cache)
+MAX_ATTACHMENT_SIZE = int(os.getenv('MAX_ATTACHMENT_SIZE', str(20 * 1024 * 1024)))  # per file, before shrinking
+MAX_REQUEST_DOWNLOAD = int(os.getenv('MAX_REQUEST_DOWNLOAD', str(32 * 1024 * 1024)))  # all files of one request
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', '1536'))  # px, larger images are downsampled
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+IMAGE_EXTENSIONS = {'.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg',
+                    '.gif': 'image/gif', '.webp': 'image/webp'}
+
+ImagePart = namedtuple("ImagePart", ["mime_type", "data", "sha256"])
+
+class AttachmentError(Exception):
+    """Attachment rejected, the message is shown to the user"""
+
+IMAGE_CACHE_TTL = 24 * 3600  # seconds
+
+class ImageCache:
+    """Processed images (ImagePart) by content hash, LRU + TTL, capped by their bytes.
+
+    Attachment ids only point at a hash, so an image seen again (same message or re-posted) is stored once.
+    """
+    def __init__(self, ttl, max_bytes, max_attachments=10000):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_attachments = max_attachments
+        self.parts = OrderedDict()  # sha256 -> (expires_at, part)
+        self.attachments = OrderedDict()  # attachment id -> sha256, oldest first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def for_attachment(self, attachment_id):
+        """The processed image of an attachment seen before, None means download it"""
+        sha256 = self.attachments.get(attachment_id)
+        part = self.lookup(sha256) if sha256 else None
+        if part:
+            self.hits += 1
+        return part
+
+    def get(self, sha256):
+        """The processed image for downloaded content, None means shrink it"""
+        part = self.lookup(sha256)
+        if part:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return part
+
+    def lookup(self, sha256):
+        entry = self.parts.get(sha256)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self.remove(sha256)
+            return None
+        self.parts.move_to_end(sha256)
+        return entry[1]
+
+    def put(self, attachment_id, part):
+        self.attachments[attachment_id] = part.sha256
+        self.attachments.move_to_end(attachment_id)
+        while len(self.attachments) > self.max_attachments:
+            self.attachments.popitem(last=False)
+        if part.sha256 in self.parts or len(part.data) > self.max_bytes:
+            return
+        self.parts[part.sha256] = (time.monotonic() + self.ttl, part)
+        self.total_bytes += len(part.data)
+        while self.total_bytes > self.max_bytes:
+            self.remove(next(iter(self.parts)))
+            self.evictions += 1
+
+    def remove(self, sha256):
+        entry = self.parts.pop(sha256, None)
+        if entry:
+            self.total_bytes -= len(entry[1].data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "images": len(self.parts),
+            "attachments": len(self.attachments),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+image_cache = ImageCache(IMAGE_CACHE_TTL, IMAGE_CACHE_MAX_BYTES)
+
+def attachment_mime_type(attachment):
+    """Image mime type from discord's metadata (extension as fallback), None if it's not a supported image"""
+    content_type = (attachment.content_type or "").split(";")[0].strip().lower()
+    if not content_type:
+        content_type = IMAGE_EXTENSIONS.get(os.path.splitext(attachment.filename.lower())[1], "")
+    return content_type if content_type in SUPPORTED_IMAGE_TYPES else None
+
+def shrink_image(data, mime_type):
+    """Downsample to IMAGE_MAX_DIMENSION (runs in a worker thread), returns (data, mime_type)"""
+    if Image is None:
+        return data, mime_type
+    with Image.open(io.BytesIO(data)) as img:
+        if max(img.size) <= IMAGE_MAX_DIMENSION and len(data) <= MAX_IMAGE_SIZE:
+            return data, mime_type
+        img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=85)
+        return out.getvalue(), "image/jpeg"
+
+async def load_attachment(attachment, mime_type):
+    cached = image_cache.for_attachment(attachment.id)
+    if cached:
+        return cached
+    data = await attachment.read()
+    sha256 = hashlib.sha256(data).hexdigest()
+    part = image_cache.get(sha256)
+    if part is None:
+        shrunk, shrunk_type = await asyncio.to_thread(shrink_image, data, mime_type)
+        part = ImagePart(shrunk_type, shrunk, sha256)
+    image_cache.put(attachment.id, part)
+    return part
+
+async def load_images(attachments):
+    """Validate image attachments from metadata, then download and shrink them concurrently.
+
+    Non-image attachments are skipped, raises AttachmentError when the images are too big.
+    """
+    images = [(attachment, attachment_mime_type(attachment)) for attachment in attachments]
+    images = [(attachment, mime_type) for attachment, mime_type in images if mime_type]
+    if any(attachment.size > MAX_ATTACHMENT_SIZE for attachment, _ in images):
+        raise AttachmentError(f"⚠️ Images can be at most {MAX_ATTACHMENT_SIZE // (1024 * 1024)}MB each.")
+    if sum(attachment.size for attachment, _ in images) > MAX_REQUEST_DOWNLOAD:
+        raise AttachmentError("⚠️ Total image size too large.")
+
+    parts = await asyncio.gather(*(load_attachment(attachment, mime_type) for attachment, mime_type in images))
+    if sum(len(part.data) for part in parts) > MAX_IMAGE_SIZE:
+        raise AttachmentError("⚠️ Total image size too large.")
+    return list(parts)
+
+def image_blobs(parts):
+    """Gemini inline data parts"""
+    return [{"mime_type": part.mime_type, "data": part.data} for part in parts]
+
+# Image analysis results on disk, keyed by image content + prompt + model (re-posted memes answer instantly)
+ANALYSIS_CACHE_ENABLED = os.getenv('ANALYSIS_CACHE', '1') == '1'
+ANALYSIS_CACHE_DIR = os.getenv('ANALYSIS_CACHE_DIR', os.path.join(BOT_DIR, 'cache', 'analysis'))
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv('ANALYSIS_CACHE_MAX_BYTES', str(50 * 1024 * 1024)))
+
+class AnalysisCache:
+    """Content-addressed result files, least recently used files are deleted past max_bytes"""
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index = OrderedDict()  # key -> file size, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def start(self):
+        await asyncio.to_thread(self.load)
+
+    def load(self):
+        """Create the directory and index the files already in it (worker thread, at startup)"""
+        os.makedirs(self.directory, exist_ok=True)
+        # file mtimes carry the LRU order across restarts
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.txt'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(files):
+            self.index[key] = size
+            self.total_bytes += size
+
+    @staticmethod
+    def key(image_parts, prompt, model_name):
+        return request_key(model_name, prompt, *(part.sha256 for part in image_parts))
+
+    @staticmethod
+    def attachment_key(attachments, prompt, model_name):
+        """Key from discord's metadata (attachment ids never get new content), checked before downloading"""
+        return request_key(model_name, prompt, *(f"attachment:{a.id}:{a.size}" for a in attachments))
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.txt')
+
+    def read(self, key):
+        path = self.path(key)
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        os.utime(path)  # mark as recently used
+        return text
+
+    def write(self, key, text):
+        tmp_path = self.path(key) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, self.path(key))
+
+    async def get(self, key):
+        if key not in self.index:
+            self.misses += 1
+            return None
+        try:
+            text = await asyncio.to_thread(self.read, key)
+        except OSError:
+            self.total_bytes -= self.index.pop(key, 0)
+            self.misses += 1
+            return None
+        self.index.move_to_end(key)
+        self.hits += 1
+        return text
+
+    async def put(self, key, text):
+        size = len(text.encode('utf-8'))
+        try:
+            await asyncio.to_thread(self.write, key, text)
+        except OSError as e:
+            log.warning("writing analysis cache failed", exc_info=e)
+            return
+        self.total_bytes += size - self.index.pop(key, 0)
+        self.index[key] = size
+        evicted = []
+        while self.total_bytes > self.max_bytes and len(self.index) > 1:
+            old_key, old_size = self.index.popitem(last=False)
+            self.total_bytes -= old_size
+            evicted.append(self.path(old_key))
+            self.evictions += 1
+        if evicted:
+            await asyncio.to_thread(remove_files, evicted)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.index),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+analysis_cache = AnalysisCache(ANALYSIS_CACHE_DIR, ANALYSIS_CACHE_MAX_BYTES) if ANALYSIS_CACHE_ENABLED else None
+
+def get_response_title(question, style, intent=None):
     """Get appropriate title for response based on question type and style"""
     style_icons = {
         "professional": "👔",
@@ -445,24 +2705,66 @@ def get_response_title(question, style):
     #  icon
     style_icon = style_icons.get(style, "🤖")
     
+    intent = intent or classify_question(question)
+
     # Check casual chat
-    if is_casual_chat(question):
+    if intent.is_casual:
         return "👋 Chat"
         
     # Check these qíe
-    is_followup = any(word in question.lower() for word in [
-        "more", "explain more", "tell me more", "elaborate", 
-        "details", "examples", "continue", "what else"
-    ]) or question.lower().strip() in ["more"]
-    
-    if is_followup:
+    if intent.is_followup:
         return f"{style_icon} Detailed Response"
         
     return f"{style_icon} Quick Overview"
 
+def build_response_embeds(question, response_text, style, intent):
+    """Lay out a text answer as embeds (code answers get their own fields), send with send_embeds"""
+    if intent.kind == "code":
+        # code responses (:3)
+        pager = EmbedPager("💻 Generated Code", discord.Color.green())
+        sections = markdown_sections(response_text)
+        for i, (kind, body) in enumerate(sections):
+            if kind == "code":
+                pager.add_field("Code", body)
+            elif i == 0:
+                pager.add_description(body)  # explanation before the code
+            else:
+                pager.add_field("Additional Information", body)
+    else:
+        # non-code responses
+        pager = EmbedPager(f"{get_response_title(question, style, intent)}", discord.Color.blue())
+        pager.add_description(response_text)
+
+    # make sure we have 1 field
+    embed = pager.embeds[0]
+    if not embed.description and len(embed.fields) == 0: # Add empty field if no description
+        embed.description = "I generated a response but couldn't format it properly. Please try asking in a different way."
+
+    return pager.embeds
+
+@bot.before_invoke
+async def start_request(ctx):
+    begin_request(ctx)
+    ctx.started_at = time.perf_counter()
+
+@bot.after_invoke
+async def finish_request(ctx):
+    """One log line per command with its total time and the time of each span"""
+    log.info("command finished", extra={"fields": {
+        "failed": ctx.command_failed,
+        "shed_by": getattr(ctx, "shed_by", None),  # lane that was full, the command never ran
+        "total_ms": round((time.perf_counter() - ctx.started_at) * 1000, 1),
+        **(request_timings.get() or {}),
+    }})
+
 @bot.event 
 async def on_ready():
-    print(f'{bot.user} has connected to Discord!')
+    log.info("connected to discord", extra={"fields": {
+        "user": str(bot.user),
+        "guilds": len(bot.guilds),
+        "shards": sorted(bot.shards) if bot.shard_count else None,
+        "shard_count": bot.shard_count,
+    }})
     await bot.change_presence(activity=discord.Game(name="Type !help"))
 
 @bot.command(name='help') # Help command
@@ -477,7 +2779,7 @@ async def help(ctx):
     # Main 
     main_commands = (
         "**🗣️ Chat Commands**\n"
-        "`!ask <question>` - Ask me anything! I can help with:\n"
+        "`!ask <question>` or `/ask` - Ask me anything! I can help with:\n"
         "• General questions and explanations\n"
         "• Code-related questions and debugging\n"
         "• Image analysis (attach an image)\n"
@@ -491,6 +2793,7 @@ async def help(ctx):
         "`!styles` - View available chat styles\n"
         "`!ask set_setting style <style>` - Change my chat style\n"
         "`!settings` - View your current settings\n"
+        "`/set` - Change style, temperature, length or language\n"
     )
     embed.add_field(name="Personalization", value=style_commands, inline=False)
 
@@ -576,8 +2879,7 @@ async def set_setting(ctx, setting: str = None, value: str = None):
                 raise ValueError(f"Style must be one of: {', '.join(AVAILABLE_STYLES.keys())}")
 
         settings[setting] = value
-        user_settings[str(ctx.author.id)] = settings
-        save_settings()
+        settings_store.set(ctx.author.id, settings)
         
         if setting == "style":
             await ctx.send(f"✅ Style set to: {value} ({AVAILABLE_STYLES[value]})")
@@ -589,55 +2891,139 @@ async def set_setting(ctx, setting: str = None, value: str = None):
 @bot.command(name='reset') # Reset command
 async def reset_settings(ctx):
     """Reset settings to default"""
-    user_settings[str(ctx.author.id)] = DEFAULT_SETTINGS.copy()
-    save_settings()
+    settings_store.reset(ctx.author.id)
     await ctx.send("✅ Settings have been reset to default")
 
 @bot.command(name='clear') # Clear command
 async def clear_conversation(ctx):
     """Clear the conversation history"""
-    conv = get_conversation(ctx.author.id, ctx.channel.id)
+    conv = await get_conversation(ctx.author.id, ctx.channel.id)
     conv.clear()
     await ctx.send("✨ Conversation history has been cleared!")
 
+# stats read at scrape time, nothing extra on the hot path
+metrics.collect("conversations", lambda: conversation_store.stats())
+metrics.collect("admission", lambda: admission.stats())
+metrics.collect("circuit", lambda: circuit_breaker.stats())
+metrics.collect("coalescing", lambda: inflight.stats())
+metrics.collect("lane", lane_stats, label="lane")
+metrics.collect("response_cache", lambda: response_cache.stats())
+metrics.collect("image_cache", lambda: image_cache.stats())
+if analysis_cache:
+    metrics.collect("analysis_cache", lambda: analysis_cache.stats())
+
+def format_stats(stats):
+    """One `name: value` line per stat"""
+    return "\n".join(f"{name}: {value:.2%}" if name == "hit_rate" else f"{name}: {value}"
+                     for name, value in stats.items())
+
+@bot.command(name='stats') # Stats command (owner only)
+@commands.is_owner()
+async def stats(ctx):
+    """Show internal store stats"""
+    embed = discord.Embed(title="📊 Bot Stats", color=discord.Color.blue())
+    if bot.shard_count:
+        embed.add_field(name="Shards", value=format_stats({
+            "this_shard": shard_for(ctx.guild.id if ctx.guild else None),
+            "local_shards": ",".join(str(shard_id) for shard_id in sorted(bot.shards)),
+            "shard_count": bot.shard_count,
+            "workers": SHARD_WORKERS,
+            "guilds": len(bot.guilds),
+        }), inline=False)
+    embed.add_field(name="Conversations", value=format_stats(conversation_store.stats()), inline=False)
+    embed.add_field(name="Gemini Circuit", value=format_stats(circuit_breaker.stats()), inline=False)
+    embed.add_field(name="Admission", value=format_stats(admission.stats()), inline=False)
+    embed.add_field(name="Request Coalescing", value=format_stats(inflight.stats()), inline=False)
+    embed.add_field(name="Lanes", value="\n".join(
+        f"{name}: {lane.running}/{lane.concurrency} running, {lane.waiting}/{lane.queue_limit} waiting, "
+        f"{lane.rejected} rejected"
+        for name, lane in lanes.items()
+    ), inline=False)
+    if analysis_cache:
+        embed.add_field(name="Image Analysis Cache", value=format_stats(analysis_cache.stats()), inline=False)
+    if RESPONSE_CACHE_ENABLED:
+        embed.add_field(name="Response Cache", value=format_stats(response_cache.stats()), inline=False)
+    if METRICS_ENABLED:
+        embed.add_field(name="Latency", value=format_stats(metrics.latency_summary()) or "nothing yet", inline=False)
+        embed.add_field(name="Counters", value=format_stats(metrics.counter_summary()) or "nothing yet", inline=False)
+    await ctx.send(embed=embed)
+
+@bot.command(name='usage') # Token usage (owner only)
+@commands.is_owner()
+async def usage(ctx):
+    """Show today's token usage"""
+    def lines(table, label):
+        rows = [f"{label(key)}: {prompt + output:,} tokens ({requests} req, {prompt:,} in / {output:,} out)"
+                for key, (requests, prompt, output) in usage_tracker.top(table)]
+        return "\n".join(rows) or "nothing yet"
+
+    embed = discord.Embed(title=f"🧮 Token Usage ({usage_tracker.day} UTC)", color=discord.Color.blue())
+    embed.add_field(name="By Command", value=lines(usage_tracker.commands, str), inline=False)
+    embed.add_field(name="Top Users", value=lines(usage_tracker.users, lambda user_id: f"<@{user_id}>"), inline=False)
+    embed.add_field(name="Top Servers", value=lines(usage_tracker.guilds, lambda guild_id: str(bot.get_guild(guild_id) or guild_id)), inline=False)
+    embed.set_footer(text=f"Daily budget: {DAILY_TOKEN_BUDGET_USER:,} per user, {DAILY_TOKEN_BUDGET_GUILD:,} per server")
+    await ctx.send(embed=embed)
+
+@bot.command(name='reload_prompts') # Reload prompt templates (owner only)
+@commands.is_owner()
+async def reload_prompts(ctx):
+    """Reload prompt templates from PROMPTS_FILE"""
+    try:
+        load_prompts()
+    except (OSError, ValueError) as e:
+        await ctx.send(f"❌ Couldn't load {os.path.basename(PROMPTS_FILE)}: {str(e)}")
+        return
+    await ctx.send(f"✅ Prompt templates reloaded ({len(prompts['prefixes'])} style/intent prefixes)")
+
+@bot.command(name='reload_routes') # Reload model routing (owner only)
+@commands.is_owner()
+async def reload_routes(ctx):
+    """Reload model routing from ROUTES_FILE"""
+    try:
+        load_routes()
+    except (OSError, ValueError) as e:
+        await ctx.send(f"❌ Couldn't load {os.path.basename(ROUTES_FILE)}: {str(e)}")
+        return
+    default = routing["default"]
+    await ctx.send(f"✅ Model routing reloaded: {default['mode']} ({default['fast_model']} / {default['strong_model']}), "
+                   f"{len(routing['guilds'])} guild overrides")
+
 @bot.command(name='summarize') # Summarize command
 async def summarize_conversation(ctx):
     """Summarize the current conversation"""
-    conv = get_conversation(ctx.author.id, ctx.channel.id)
-    if not conv.history:
+    conv = await get_conversation(ctx.author.id, ctx.channel.id)
+    if not conv.history and not conv.summary:
         await ctx.send("No conversation history to summarize!")
         return
 
-    async with ctx.typing():
-        try:
-            # summary prompt
-            history_text = "\n".join([
-                f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['parts'][0]}" 
-                for msg in conv.history
-            ])
-            
-            prompt = f"""Please provide a brief summary of this conversation:
+    if not await check_budget(ctx):
+        return
 
-{history_text}
+    # summary prompt
+    prompt = build_summary_prompt(conv.history, conv.summary)
+    if not await admit_request(ctx, estimate_tokens(prompt)):
+        return
 
-Focus on the main points discussed and key conclusions."""
-            
-            response = model.generate_content(prompt) # Generate
+    async with ctx.typing():
+        try:
+            response, shared = await inflight.do(
+                request_key(MODEL_NAMES["summarize"], prompt),
+                lambda: generate_content_async(model_for("summarize"), prompt) # Generate
+            )
+            if not shared:
+                record_usage(ctx, "summarize", response)
             summary = get_response_text(response) # Get response t
             
             if not summary:
                 await ctx.send("❌ Failed to generate summary. Please try again.")
                 return
 
-            if len(summary) > 4096:  # Limit to 4096 chars (discord)
-                summary = summary[:4093] + "..."
-            
-            embed = discord.Embed(
-                title="Conversation Summary",
-                description=summary,
-                color=discord.Color.blue()
-            )
-            await ctx.send(embed=embed) # Send embed
+            pager = EmbedPager("Conversation Summary", discord.Color.blue())
+            pager.add_description(summary)
+            await send_embeds(ctx, pager.embeds) # Send embeds
+        except GeminiError as e:
+            log.warning("summarize failed", extra={"fields": {"error": type(e).__name__, "model": MODEL_NAMES["summarize"]}}, exc_info=e)
+            await ctx.send(e.user_message)
         except Exception as e:
             await ctx.send(f"❌ Error generating summary: {str(e)}") # Error
 
@@ -648,217 +3034,202 @@ async def ask(ctx, *, question=None):
         await ctx.send("Give me a question! : !ask <your question>")
         return
 
-    if ctx.message.id in message_history:
+    if not message_history.add(ctx.message.id):
         return
 
-    message_history[ctx.message.id] = True
-    settings = get_user_settings(ctx.author.id)
+    started = time.perf_counter()
+    with span("settings"):
+        settings = get_user_settings(ctx.author.id)
+    intent = classify_question(question)
+    plan = await check_budget(ctx)
+    if not plan:
+        return
+
+    # Get conversation 
+    conv = await get_conversation(ctx.author.id, ctx.channel.id)
+    est_tokens = estimate_tokens(question) + sum(
+        estimate_tokens(msg["parts"][0]) for msg in conv.get_messages(plan.history_budget)
+    )
+    route = route_request(intent, settings["style"], est_tokens, settings["max_tokens"], plan,
+                          ctx.guild.id if ctx.guild else None)
+
+    # only fresh conversations are cached, anything else was generated with this user's history / summary
+    fresh = not (conv.history or conv.summary)
+    cache_key = None
+    if RESPONSE_CACHE_ENABLED and not ctx.message.attachments:
+        if fresh:
+            cache_key = response_cache_key(question, settings, route)
+        else:
+            response_cache.bypasses += 1
+
+    # a cached answer costs no model call, so it skips admission
+    cached_text = response_cache.get(cache_key) if cache_key else None
+    if cached_text:
+        conv.add_message("user", question, intent)
+        conv.add_message("assistant", cached_text)
+        await send_embeds(ctx, build_response_embeds(question, cached_text, settings['style'], intent))
+        return
+    if not await admit_request(ctx, est_tokens):
+        return
     
     async with ctx.typing(): 
         try:
-            # Get conversation 
-            conv_key = f"{ctx.author.id}_{ctx.channel.id}"
-            if conv_key not in conversations:
-                conversations[conv_key] = Conversation()
-            conv = conversations[conv_key]
-            
-            style_prompt = get_style_prompt(settings["style"])
-            
             # Add user message to history before generate any response (work lo? :v dunno why)
-            conv.add_message("user", question)
+            conv.add_message("user", question, intent)
 
             # image attach
             if ctx.message.attachments:
                 try:
-                    image_parts = []
-                    total_size = 0
-                    
-                    for attachment in ctx.message.attachments:
-                        if attachment.content_type in SUPPORTED_IMAGE_TYPES:
-                            # Check file size
-                            if total_size + attachment.size > MAX_IMAGE_SIZE:
-                                await ctx.send("⚠️ Total image size too large.")
-                                return
-                            
-                            image_data = await attachment.read()
-                            total_size += len(image_data)
-                            
-                            image_parts.append({
-                                "mime_type": attachment.content_type,
-                                "data": image_data
-                            })
+                    with span("attachments", count=len(ctx.message.attachments)):
+                        image_parts = await load_images(ctx.message.attachments)
                     
                     if image_parts:
                         # Use Gemini Pro Vision 
-                        vision_model = genai.GenerativeModel('gemini-pro-vision')
-                        prompt = [{"text": get_enhanced_prompt(question, style_prompt, conv)}] 
-                        prompt.extend(image_parts)
-                        
-                        response = vision_model.generate_content(prompt)
-                        response_text = get_response_text(response)
-                        
+                        vision_model, styled = styled_model_for("ask_image", settings["style"])
+                        prompt = [{"text": get_enhanced_prompt(question, settings["style"], conv, intent, not styled)}] 
+                        prompt.extend(image_blobs(image_parts))
+
+                        # same images + same prompt (incl. system instruction) + same model -> cached analysis,
+                        # only without earlier turns (they're part of the prompt, so the key would never repeat)
+                        analysis_key = None
+                        if analysis_cache and fresh:
+                            prompt_variant = prompt[0]["text"] + (get_system_instruction(settings["style"]) if styled else "")
+                            analysis_key = analysis_cache.key(image_parts, prompt_variant, MODEL_NAMES["ask_image"])
+                        response_text = await analysis_cache.get(analysis_key) if analysis_key else None
+
                         if not response_text:
-                            await ctx.send("❌ I couldn't analyze the image(s). Please try again.")
-                            return
+                            flight_key = analysis_key or request_key(
+                                MODEL_NAMES["ask_image"], prompt[0]["text"], styled, settings["style"],
+                                *(part.sha256 for part in image_parts)
+                            )
+                            with span("gemini", model=MODEL_NAMES["ask_image"], images=len(image_parts)):
+                                response, shared = await inflight.do(
+                                    flight_key, lambda: generate_content_async(vision_model, prompt)
+                                )
+                            if not shared:
+                                record_usage(ctx, "ask_image", response)
+                            response_text = get_response_text(response)
+
+                            if not response_text:
+                                await ctx.send("❌ I couldn't analyze the image(s). Please try again.")
+                                return
+                            if analysis_key:
+                                await analysis_cache.put(analysis_key, response_text)
                         
                         # Process image response ( style)
                         is_casual = settings["style"] in ["friendly", "creative"]
                         final_response = process_image_response(response_text, is_casual)
                         
                         #  embed for image response
-                        embed = discord.Embed(
-                            title="🖼️ Image Analysis",
-                            description=final_response,
-                            color=discord.Color.blue()
-                        )
+                        pager = EmbedPager("🖼️ Image Analysis", discord.Color.blue())
+                        pager.add_description(final_response)
                         
                         # Add thumbnail 
                         if ctx.message.attachments:
-                            embed.set_thumbnail(url=ctx.message.attachments[0].url)
+                            pager.embeds[0].set_thumbnail(url=ctx.message.attachments[0].url)
                         
-                        await ctx.send(embed=embed)
+                        await send_embeds(ctx, pager.embeds)
                         return
                 
+                except GeminiError:
+                    raise
+                except AttachmentError as e:
+                    await ctx.send(str(e))
+                    return
                 except Exception as e:
                     await ctx.send(f"❌ Error processing image: {str(e)}")
                     return
             
-            # text based
-            chat = model.start_chat(history=conv.get_messages())
-            
-            #  get style config
-            style_config = get_style_config(settings["style"])
-            config = genai.types.GenerationConfig(
-                temperature=style_config["temperature"],
-                top_p=style_config["top_p"],
-                top_k=40,
-                max_output_tokens=settings["max_tokens"],
-                candidate_count=1
-            )
+            # text based (model and answer length picked by route_request)
+            with span("prompt"), metrics.timer("bot_ask_phase_seconds", phase="prompt"):
+                config = generation_config_for(settings["style"], route.max_tokens)
+
+                # enhanced prompt
+                text_model, styled = styled_model_for("ask", settings["style"], route.model_name)
+                enhanced_prompt = get_enhanced_prompt(question, settings["style"], conv, intent, not styled)
 
-            # enhanced prompt
-            enhanced_prompt = get_enhanced_prompt(question, style_prompt, conv)
-            
             #  response
-            chat = model.start_chat(history=conv.get_messages()) # Start chat
-            response = chat.send_message( 
-                enhanced_prompt,
-                generation_config=config
+            history = conv.get_messages(plan.history_budget)
+            chat = text_model.start_chat(history=history) # Start chat
+            # code answers need the full text to lay out their fields, so only stream the rest
+            streamed = STREAM_RESPONSES and intent.kind != "code"
+
+            async def generate():
+                generate_started = time.perf_counter()
+                if streamed:
+                    chunks = stream_message_async(chat, enhanced_prompt, generation_config=config)
+                    text, usage = await stream_response(
+                        ctx, chunks, get_response_title(question, settings['style'], intent)
+                    )
+                else:
+                    response = await send_message_async(
+                        chat,
+                        enhanced_prompt,
+                        generation_config=config
+                    )
+                    text, usage = get_response_text(response), getattr(response, "usage_metadata", None)
+                    metrics.observe("bot_ask_phase_seconds", time.perf_counter() - generate_started, phase="first_token")
+                metrics.observe("bot_ask_phase_seconds", time.perf_counter() - generate_started, phase="gemini")
+                record_route(route, time.perf_counter() - generate_started, usage)
+                usage_tracker.record(ctx.author.id, ctx.guild.id if ctx.guild else None, "ask", usage)
+                return text
+
+            # another user asking the exact same thing right now -> wait for their answer instead
+            flight_key = request_key(
+                route.model_name, styled, settings["style"], route.max_tokens, enhanced_prompt,
+                [(msg["role"], msg["parts"][0]) for msg in history]
             )
+            with span("gemini", model=route.model_name, route=route.name, streamed=bool(streamed)):
+                response_text, shared = await inflight.do(flight_key, generate)
 
             # Process response
-            response_text = get_response_text(response)
             if not response_text:
                 await ctx.send("❌ I couldn't generate a proper response.")
                 return
 
             # Add bot response to conversation history (gud fixed)
             conv.add_message("assistant", response_text)
-
-            # Create embed 
-            if any(keyword in question.lower() for keyword in [
-                "write code", "generate code", "create a program", "write a function",
-                "write a class", "implement", "code example", "write script",
-                "programming", "function to", "class that", "code for"
-            ]):
-                # code responses (:3)
-                embed = discord.Embed(
-                    title="💻 Generated Code",
-                    color=discord.Color.green()
-                )
-
-                # Split into code blocks and explanation
-                parts = response_text.split("```")
-                
-                # Add explanation before code blocks
-                if parts[0].strip():
-                    # Limit  length
-                    explanation = parts[0].strip()[:1000]  # Limit to 1000 chars
-                    embed.description = explanation
-
-                # Process code blocks
-                for i in range(1, len(parts), 2):
-                    if i < len(parts):
-                        # get lang and code
-                        block = parts[i].strip()
-                        if '\n' in block:
-                            lang, *code_lines = block.split('\n')   # Split into lang and code
-                            code = '\n'.join(code_lines)
-                        else:
-                            lang = 'python'  # default lang
-                            code = block
-
-                        # Split code into smaller parts if too long
-                        if len(code) > 1024:
-                            code_parts = [code[j:j+800] for j in range(0, len(code), 800)]  # Split into 800-char parts
-                            for k, part in enumerate(code_parts): # Add each part as a field
-                                field_value = f"```{lang}\n{part}\n```"
-                                if len(field_value) <= 1024:  #    length
-                                    embed.add_field( 
-                                        name=f"Code Part {k+1}", # Add part number
-                                        value=field_value,
-                                        inline=False
-                                    )
-                        else:
-                            field_value = f"```{lang}\n{code}\n```"
-                            if len(field_value) <= 1024:  # Limit to 1024 chars verify field length
-                                embed.add_field(
-                                    name=f"Code",
-                                    value=field_value,
-                                    inline=False
-                                )
-
-                #  additional info for res
-                if len(parts) > 2 and parts[-1].strip(): # Add additional info 
-                    additional_info = parts[-1].strip()[:1000]  # Limit to 1000 chars
-                    embed.add_field(
-                        name="Additional Information",
-                        value=additional_info,
-                        inline=False
-                    )
-
-            else:
-                # non-code responses
-                embed = discord.Embed(
-                    title=f"{get_response_title(question, settings['style'])}", 
-                    color=discord.Color.blue()
-                )
-
-                if len(response_text) > 4096: # Limit to 4096 chars
-                    # Split into smaller , ensuring each is under 1024
-                    chunks = [response_text[i:i+800] for i in range(0, len(response_text), 800)] # Split into 800-char parts
-                    for i, chunk in enumerate(chunks): # Add each part as a field
-                        embed.add_field(
-                            name=f"Part {i+1}" if i > 0 else "Response",
-                            value=chunk,
-                            inline=False
-                        )
-                else:
-                    embed.description = response_text[:4096]  # Limit to 4096 chars for description
-
-            # make sure we have 1 field
-            if not embed.description and len(embed.fields) == 0: # Add empty field if no description
-                embed.description = "I generated a response but couldn't format it properly. Please try asking in a different way."
-
-            await ctx.send(embed=embed) # Send embed
-
+            schedule_compaction(conv)
+            if cache_key and plan.level == 0:  # degraded answers aren't worth sharing
+                response_cache.put(cache_key, response_text)
+
+            if streamed and not shared:
+                return  # already on screen
+
+            with span("format"), metrics.timer("bot_ask_phase_seconds", phase="format"):
+                embeds = build_response_embeds(question, response_text, settings['style'], intent)
+            with span("send"), metrics.timer("bot_ask_phase_seconds", phase="send"):
+                await send_embeds(ctx, embeds) # Send embeds
+
+        except GeminiError as e:
+            log.warning("ask failed", extra={"fields": {"error": type(e).__name__, "model": route.model_name, "route": route.name}}, exc_info=e)
+            metrics.inc("bot_command_errors_total", command="ask", error=type(e).__name__)
+            await ctx.send(e.user_message)
         except Exception as e: # Error handling
-            error_message = str(e) # Get error message
-            print(f"Error details: {error_message}")  # Log the full error
-            if "quota" in error_message.lower():
-                await ctx.send("❌ API quota exceeded.")
-            elif "safety" in error_message.lower():
-                await ctx.send("❌ I cannot provide a response to that type of question")
-            else:
-                await ctx.send(f"❌ An error occurred: {str(e)}\nPlease try asking in a different way.")
+            log.exception("ask failed", extra={"fields": {"error": type(e).__name__}})
+            metrics.inc("bot_command_errors_total", command="ask", error=type(e).__name__)
+            await ctx.send(f"❌ An error occurred: {str(e)}\nPlease try asking in a different way.")
+        finally:
+            metrics.observe("bot_ask_seconds", time.perf_counter() - started)
 
 @bot.command(name='reset_conversation') 
 async def reset_conversation(ctx):
     """Reset the conversation context"""
-    conv = get_conversation(ctx.author.id, ctx.channel.id)
+    conv = await get_conversation(ctx.author.id, ctx.channel.id)
     conv.clear()
     await ctx.send("The conversation has been reset.")
 
+# prompt for !analyze (promt from chat gpt :)) )
+ANALYZE_PROMPT = """Please provide a detailed analysis of this image. Include:
+1. Description of what's in the image
+2. Notable details and features
+3. Colors, composition, and style
+4. Any text or symbols if present
+5. Context or setting
+6. Technical aspects (if relevant)
+
+Please be specific and thorough in your analysis."""
+
 @bot.command(name='analyze') # Analyze command
 async def analyze_image(ctx):
     """Analyze an attached image"""
@@ -868,64 +3239,195 @@ async def analyze_image(ctx):
 
     async with ctx.typing(): 
         try:
-            # Handle image attachments
-            image_parts = []
-            for attachment in ctx.message.attachments:
-                if any(attachment.filename.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.webp']): # Check file type
-                    try:
-                        image_data = await attachment.read() # Read image data
-                        image_parts.append({ # Add image parts
-                            "mime_type": attachment.content_type, # Get content type
-                            "data": image_data
-                        })
-                    except Exception as e: # Error handling
-                        await ctx.send(f"❌ Error processing image: {str(e)}")
-                        return
-
-            if not image_parts: # Check if no image parts
+            images = [attachment for attachment in ctx.message.attachments if attachment_mime_type(attachment)]
+            if not images:
                 await ctx.send("❌ Please provide a valid image ")
                 return
 
-            # enchance prompt for image analysis (promt from chat gpt :)) )
-            analysis_prompt = [
-                {
-                    "text": """Please provide a detailed analysis of this image. Include:
-1. Description of what's in the image
-2. Notable details and features
-3. Colors, composition, and style
-4. Any text or symbols if present
-5. Context or setting
-6. Technical aspects (if relevant)
+            # same attachments analyzed before? answer straight from disk, nothing downloaded or admitted
+            attachment_key = None
+            if analysis_cache:
+                attachment_key = AnalysisCache.attachment_key(images, ANALYZE_PROMPT, MODEL_NAMES["analyze"])
+            response_text = await analysis_cache.get(attachment_key) if attachment_key else None
 
-Please be specific and thorough in your analysis."""
-                }
-            ]
-            analysis_prompt.extend(image_parts)
+            if not response_text:
+                # budget and admission before any download or resize
+                if not await check_budget(ctx):
+                    return
+                if not await admit_request(ctx, 300 * len(images)):  # ~258 tokens per image + prompt
+                    return
+
+                # Handle image attachments
+                try:
+                    with span("attachments", count=len(images)):
+                        image_parts = await load_images(images)
+                except AttachmentError as e:
+                    await ctx.send(str(e))
+                    return
+                except Exception as e: # Error handling
+                    await ctx.send(f"❌ Error processing image: {str(e)}")
+                    return
+
+                analysis_prompt = [{"text": ANALYZE_PROMPT}]
+                analysis_prompt.extend(image_blobs(image_parts))
+
+                # seen these exact images before (re-posted)? no model call
+                analysis_key = AnalysisCache.key(image_parts, ANALYZE_PROMPT, MODEL_NAMES["analyze"])
+                response_text = await analysis_cache.get(analysis_key) if analysis_cache else None
 
-            # Use Gemini 1.5 Flash
-            vision_model = genai.GenerativeModel('gemini-1.5-flash')
-            response = vision_model.generate_content(analysis_prompt)
-            
-            # Process and send response
-            response_text = get_response_text(response)
             if not response_text:
-                await ctx.send("❌ Failed to analyze the image. Please try again.")
-                return
+                # Use Gemini 1.5 Flash
+                vision_model = model_for("analyze")
+                with span("gemini", model=MODEL_NAMES["analyze"], images=len(image_parts)):
+                    response, shared = await inflight.do(
+                        analysis_key, lambda: generate_content_async(vision_model, analysis_prompt)
+                    )
+                if not shared:
+                    record_usage(ctx, "analyze", response)
+                
+                # Process and send response
+                response_text = get_response_text(response)
+                if not response_text:
+                    await ctx.send("❌ Failed to analyze the image. Please try again.")
+                    return
+                if analysis_cache:
+                    await analysis_cache.put(analysis_key, response_text)
+            if analysis_cache and attachment_key not in analysis_cache.index:
+                await analysis_cache.put(attachment_key, response_text)
 
             # embed now :3 anddd end
-            embed = discord.Embed(
-                title="📸 Image Analysis",
-                description=response_text,
-                color=discord.Color.blue()
-            )
-            await ctx.send(embed=embed)
-
+            pager = EmbedPager("📸 Image Analysis", discord.Color.blue())
+            pager.add_description(response_text)
+            await send_embeds(ctx, pager.embeds)
+
+        except GeminiBlockedError:
+            await ctx.send("❌ I cannot analyze this type of image. Please try a different one.")
+        except (GeminiQuotaError, GeminiUnavailableError, CircuitOpenError) as e:
+            log.warning("analyze failed", extra={"fields": {"error": type(e).__name__, "model": MODEL_NAMES["analyze"]}}, exc_info=e)
+            await ctx.send(e.user_message)
         except Exception as e: 
-            error_message = str(e)
-            if "safety" in error_message.lower():
-                await ctx.send("❌ I cannot analyze this type of image. Please try a different one.")
-            else:
-                print(f"Error details: {error_message}")
-                await ctx.send("❌ An error occurred while analyzing the image. Please try again.")
+            log.exception("analyze failed", extra={"fields": {"error": type(e).__name__, "model": MODEL_NAMES["analyze"]}})
+            await ctx.send("❌ An error occurred while analyzing the image. Please try again.")
+
+# Slash commands (acknowledged within milliseconds, discord validates the options, the answer follows up)
+async def run_slash(interaction, handler, *args, ephemeral=False, **kwargs):
+    """Defer right away, then run the prefix command's handler on a context that replies with followups.
+
+    Attachment options are already on ctx.message.attachments (from_interaction copies them there).
+    """
+    await interaction.response.defer(thinking=True, ephemeral=ephemeral)
+    metrics.observe("bot_slash_ack_seconds", (discord.utils.utcnow() - interaction.created_at).total_seconds())
+    ctx = await commands.Context.from_interaction(interaction)
+    await start_request(ctx)
+    try:
+        async with lanes[command_lane(ctx)].slot():
+            await handler(ctx, *args, **kwargs)
+    except LaneFull as e:
+        await shed_request(ctx, e)
+    except Exception:
+        ctx.command_failed = True
+        raise  # on_app_command_error answers the deferred response
+    finally:
+        await finish_request(ctx)
+
+@bot.tree.error
+async def on_app_command_error(interaction, error):
+    """Never leave a slash command "thinking..." forever"""
+    command = interaction.command.name if interaction.command else "unknown"
+    log.error("slash command failed", extra={"fields": {"command": command}}, exc_info=error)
+    metrics.inc("bot_command_errors_total", command=command, error=type(getattr(error, "original", error)).__name__)
+    message = "❌ An error occurred, please try again."
+    try:
+        if interaction.response.is_done():
+            await interaction.followup.send(message, ephemeral=True)
+        else:
+            await interaction.response.send_message(message, ephemeral=True)
+    except discord.HTTPException:
+        pass  # interaction expired
+
+@bot.tree.command(name="ask", description="Ask me anything (attach an image to ask about it)")
+@app_commands.describe(question="Your question", image="Optional image to ask about")
+async def slash_ask(interaction, question: app_commands.Range[str, 1, 2000], image: discord.Attachment = None):
+    await run_slash(interaction, ask.callback, question=question)
+
+@bot.tree.command(name="analyze", description="Get a detailed analysis of an image")
+@app_commands.describe(image="The image to analyze")
+async def slash_analyze(interaction, image: discord.Attachment):
+    await run_slash(interaction, analyze_image.callback)
+
+@bot.tree.command(name="summarize", description="Summarize our conversation in this channel")
+async def slash_summarize(interaction):
+    await run_slash(interaction, summarize_conversation.callback)
+
+@bot.tree.command(name="settings", description="Show your current settings")
+async def slash_settings(interaction):
+    await run_slash(interaction, settings.callback, ephemeral=True)
+
+@bot.tree.command(name="set", description="Change your settings")
+@app_commands.describe(
+    style="Answer style",
+    temperature="Creativity, 0 (focused) to 1 (creative)",
+    max_tokens="Maximum answer length",
+    language="Answer language",
+)
+@app_commands.choices(style=[
+    app_commands.Choice(name=f"{style} - {description}"[:100], value=style)
+    for style, description in AVAILABLE_STYLES.items()
+])
+async def slash_set(interaction, style: app_commands.Choice[str] = None,
+                    temperature: app_commands.Range[float, 0.0, 1.0] = None,
+                    max_tokens: app_commands.Range[int, 100, 2000] = None,
+                    language: app_commands.Range[str, 1, 40] = None):
+    # discord already checked the ranges and choices, nothing to parse here
+    changes = {
+        "style": style.value if style else None,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "language": language,
+    }
+    changes = {setting: value for setting, value in changes.items() if value is not None}
+    if not changes:
+        await interaction.response.send_message("Pick at least one setting to change.", ephemeral=True)
+        return
+    settings = get_user_settings(interaction.user.id)
+    settings.update(changes)
+    settings_store.set(interaction.user.id, settings)
+    summary = ", ".join(f"{setting} = {value}" for setting, value in changes.items())
+    await interaction.response.send_message(f"✅ Updated: {summary}", ephemeral=True)
+
+@bot.tree.command(name="reset", description="Reset your settings to the defaults")
+async def slash_reset(interaction):
+    settings_store.reset(interaction.user.id)
+    await interaction.response.send_message("✅ Settings have been reset to default", ephemeral=True)
+
+if not SLASH_COMMANDS:
+    bot.tree.clear_commands(guild=None)  # turned off: nothing registered, so nothing is dispatched or synced
+
+async def sync_slash_commands():
+    """Register the slash commands with discord (global, or one guild for instant updates while testing)"""
+    if SLASH_SYNC_GUILD:
+        guild = discord.Object(id=int(SLASH_SYNC_GUILD))
+        bot.tree.copy_global_to(guild=guild)
+        synced = await bot.tree.sync(guild=guild)
+    else:
+        synced = await bot.tree.sync()
+    log.info("slash commands synced", extra={"fields": {"count": len(synced), "guild": SLASH_SYNC_GUILD}})
+    return synced
+
+@bot.command(name='sync_commands') # Register slash commands with discord (owner only)
+@commands.is_owner()
+async def sync_commands(ctx):
+    """Sync the slash commands, only needed after they changed (with SLASH_COMMANDS=0 it removes them)"""
+    try:
+        synced = await sync_slash_commands()
+    except discord.HTTPException as e:
+        await ctx.send(f"❌ Syncing failed: {str(e)}")
+        return
+    if not SLASH_COMMANDS:
+        await ctx.send("✅ Slash commands are turned off (SLASH_COMMANDS=0), removed them from discord")
+        return
+    await ctx.send(f"✅ Synced {len(synced)} slash commands {f'to guild {SLASH_SYNC_GUILD}' if SLASH_SYNC_GUILD else 'globally'}")
 
-bot.run(os.getenv('DISCORD_TOKEN')) 
+if __name__ == '__main__':
+    setup_logging()
+    bot.run(os.getenv('DISCORD_TOKEN'), log_handler=None)  # discord.py logs go through setup_logging too
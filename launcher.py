@@ -0,0 +1,111 @@
+# Runs the bot as several worker processes, each owning a slice of the gateway shards
+# usage: python launcher.py            (SHARD_COUNT / SHARD_WORKERS from .env)
+# Every worker runs bot.py with its own SHARD_IDS. State that has to be seen by all workers
+# (user settings, conversations) lives in the sqlite stores, so those backends are forced on.
+# Rate limits, daily budgets and caches stay per worker, the gemini quota is split evenly.
+import os
+import sys
+import time
+import signal
+import subprocess
+from dotenv import load_dotenv
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+RESTART_BACKOFF_MAX = 60  # seconds between restarts of a worker that keeps crashing
+HEALTHY_AFTER = 60  # a worker that ran this long resets its backoff
+
+def shard_slices(shard_count, workers):
+    """Round-robin shards over workers, e.g. 8 shards / 3 workers -> [0,3,6] [1,4,7] [2,5]"""
+    return [list(range(worker, shard_count, workers)) for worker in range(workers)]
+
+class Worker:
+    """One bot.py process and its restart bookkeeping"""
+    def __init__(self, index, shard_ids, env):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.env = {**env, "SHARD_IDS": ",".join(str(shard_id) for shard_id in shard_ids)}
+        if int(env.get("METRICS_PORT") or 0):
+            self.env["METRICS_PORT"] = str(int(env["METRICS_PORT"]) + index)  # one scrape target per worker
+        self.process = None
+        self.started = 0.0
+        self.backoff = 1.0
+        self.restart_at = 0.0
+
+    def start(self):
+        # own session: a Ctrl+C in the terminal reaches only the launcher, which then stops each worker once
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(BOT_DIR, "bot.py")], env=self.env, start_new_session=True
+        )
+        self.started = time.monotonic()
+        print(f"worker {self.index}: started pid {self.process.pid} for shards {self.shard_ids}")
+
+    def check(self):
+        """Restart the process if it exited, with exponential backoff"""
+        now = time.monotonic()
+        if self.process is None:
+            if now >= self.restart_at:
+                self.start()
+            return
+        code = self.process.poll()
+        if code is None:
+            if now - self.started > HEALTHY_AFTER:
+                self.backoff = 1.0
+            return
+        print(f"worker {self.index}: exited with {code}, restarting in {self.backoff:.0f}s")
+        self.process = None
+        self.restart_at = now + self.backoff
+        self.backoff = min(self.backoff * 2, RESTART_BACKOFF_MAX)
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)  # bot.close() flushes the stores
+
+    def wait(self, timeout):
+        if self.process is None:
+            return
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+def main():
+    load_dotenv()
+    shard_count = os.getenv('SHARD_COUNT', '')
+    shard_count = int(shard_count) if shard_count.isdigit() else 0
+    workers = int(os.getenv('SHARD_WORKERS', '2'))
+    if shard_count < 1 or workers < 1:
+        sys.exit("set SHARD_COUNT (total gateway shards) and SHARD_WORKERS (processes) in .env")
+    workers = min(workers, shard_count)
+
+    env = dict(os.environ, SHARD_COUNT=str(shard_count), SHARD_WORKERS=str(workers))
+    for backend in ("SETTINGS_BACKEND", "CONVERSATION_BACKEND"):
+        if env.get(backend) != "sqlite":
+            print(f"{backend}={env.get(backend, 'default')} isn't shared between processes, using sqlite")
+            env[backend] = "sqlite"
+
+    pool = [Worker(index, shard_ids, env) for index, shard_ids in enumerate(shard_slices(shard_count, workers))]
+    stopping = False
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    for worker in pool:
+        worker.start()
+        time.sleep(5)  # discord only lets one shard identify every 5s
+    while not stopping:
+        for worker in pool:
+            worker.check()
+        time.sleep(1)
+
+    print("stopping workers...")
+    for worker in pool:
+        worker.stop()
+    for worker in pool:
+        worker.wait(timeout=30)
+
+if __name__ == '__main__':
+    main()
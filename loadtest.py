@@ -0,0 +1,399 @@
+# Offline load test: drives the real command handlers with fake discord contexts and a fake gemini model
+# usage: python loadtest.py [--concurrency 50] [--requests 2000] [--mix ask=70,summarize=10,analyze=10,set=10]
+#                           [--latency 800] [--ttft 300] [--error-rate 0.02] [--no-stream] [--unique] [--json]
+# No token or api key needed, all state goes to a temp dir. Run it before and after a perf change.
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import resource
+import logging
+import shutil
+from types import SimpleNamespace
+
+STATE_DIR = tempfile.mkdtemp(prefix="gemini-bot-loadtest-")
+TEST_ENV = {
+    "SETTINGS_BACKEND": "sqlite",
+    "SETTINGS_DB": os.path.join(STATE_DIR, "settings.db"),
+    "CONVERSATION_BACKEND": "memory",
+    "CONVERSATION_DB": os.path.join(STATE_DIR, "conversations.db"),
+    "ANALYSIS_CACHE_DIR": os.path.join(STATE_DIR, "analysis"),
+    # limits are what we measure around, not what we want to hit
+    "RATE_LIMIT_USER_RPM": "1000000",
+    "RATE_LIMIT_GUILD_RPM": "1000000",
+    "GEMINI_RPM": "1000000",
+    "GEMINI_TPM": "1000000000",
+    "DAILY_TOKEN_BUDGET_USER": "1000000000",
+    "DAILY_TOKEN_BUDGET_GUILD": "1000000000",
+}
+for name, value in TEST_ENV.items():
+    os.environ.setdefault(name, value)  # anything set in the shell wins
+
+import bot  # noqa: E402  (must see the env above)
+from bench import QUESTIONS  # noqa: E402
+from google.api_core import exceptions as google_exceptions  # noqa: E402
+
+# 1x1 png, analyze requests upload a copy (plus a suffix with --unique so the caches miss)
+PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489"
+    "0000000d49444154789c6360f8cfc0f01f0005000201e2a3bd8e0000000049454e44ae426082"
+)
+ANSWER = (
+    "Here's the short version.\n\n**Key points**\n- first thing to know about it\n- second thing, with detail\n\n"
+    "```python\ndef example(values):\n    return sorted(values)\n```\n\nHope that helps! "
+)
+
+# Fake gemini
+class FakeGemini:
+    """Latency / streaming / error knobs shared by every fake model"""
+    def __init__(self, latency, ttft, chunks, error_rate, response_chars):
+        self.latency = latency
+        self.ttft = ttft
+        self.chunks = chunks
+        self.error_rate = error_rate
+        self.text = (ANSWER * (response_chars // len(ANSWER) + 1))[:response_chars]
+        self.calls = 0
+        self.streams = 0
+        self.errors = 0
+
+    def jitter(self, seconds):
+        return seconds * random.uniform(0.5, 1.5)
+
+    def maybe_fail(self):
+        if random.random() < self.error_rate:
+            self.errors += 1
+            raise google_exceptions.ServiceUnavailable("fake gemini outage")
+
+    def usage(self, prompt):
+        return SimpleNamespace(prompt_token_count=len(str(prompt)) // 4, candidates_token_count=len(self.text) // 4)
+
+    async def respond(self, prompt):
+        self.calls += 1
+        await asyncio.sleep(self.jitter(self.latency))
+        self.maybe_fail()
+        return SimpleNamespace(text=self.text, usage_metadata=self.usage(prompt))
+
+    async def open_stream(self, prompt):
+        """Fails (like a 503) before the first chunk, so the bot's retry path is exercised too"""
+        self.calls += 1
+        self.streams += 1
+        await asyncio.sleep(self.jitter(self.ttft))
+        self.maybe_fail()
+        return self.stream(prompt)
+
+    async def stream(self, prompt):
+        step = len(self.text) // self.chunks + 1
+        pieces = [self.text[i:i + step] for i in range(0, len(self.text), step)]
+        pause = max(0.0, self.latency - self.ttft) / len(pieces)
+        for i, piece in enumerate(pieces):
+            usage = self.usage(prompt) if i == len(pieces) - 1 else None
+            yield SimpleNamespace(text=piece, usage_metadata=usage)
+            await asyncio.sleep(self.jitter(pause))
+
+class FakeChat:
+    def __init__(self, gemini):
+        self.gemini = gemini
+
+    async def send_message_async(self, prompt, stream=False, **kwargs):
+        if stream:
+            return await self.gemini.open_stream(prompt)
+        return await self.gemini.respond(prompt)
+
+class FakeModel:
+    def __init__(self, gemini):
+        self.gemini = gemini
+
+    async def generate_content_async(self, prompt, **kwargs):
+        return await self.gemini.respond(prompt)
+
+    def start_chat(self, history=None):
+        return FakeChat(self.gemini)
+
+# Fake discord
+class FakeSentMessage:
+    def __init__(self, ctx):
+        self.ctx = ctx
+
+    async def edit(self, **kwargs):
+        await asyncio.sleep(self.ctx.discord_latency)
+
+    async def delete(self):
+        await asyncio.sleep(self.ctx.discord_latency)
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+class FakeAttachment:
+    def __init__(self, attachment_id, data):
+        self.id = attachment_id
+        self.filename = "image.png"
+        self.content_type = "image/png"
+        self.size = len(data)
+        self.url = f"https://cdn.example/{attachment_id}.png"
+        self.data = data
+
+    async def read(self):
+        return self.data
+
+class FakeContext:
+    """Just enough of commands.Context for the handlers, every send is recorded"""
+    def __init__(self, command, message_id, user_id, guild_id, channel_id, discord_latency, attachments=()):
+        self.command = bot.bot.get_command(command)
+        self.command_failed = False
+        self.message = SimpleNamespace(id=message_id, attachments=list(attachments))
+        self.author = SimpleNamespace(id=user_id, display_name=f"user{user_id}", mention=f"<@{user_id}>")
+        self.guild = SimpleNamespace(id=guild_id, name=f"guild{guild_id}") if guild_id else None
+        self.channel = SimpleNamespace(id=channel_id)
+        self.discord_latency = discord_latency
+        self.sent = []
+
+    async def send(self, content=None, embed=None, embeds=None, **kwargs):
+        await asyncio.sleep(self.discord_latency)
+        embed = embed or (embeds[0] if embeds else None)
+        self.sent.append(content if content is not None else getattr(embed, "description", "") or "")
+        return FakeSentMessage(self)
+
+    def typing(self):
+        return FakeTyping()
+
+    def outcome(self):
+        if any(text.startswith("❌") for text in self.sent):
+            return "error"
+        if any(text.startswith("⏳") for text in self.sent):
+            return "throttled"
+        return "ok"
+
+# Load generator
+class LoadTest:
+    def __init__(self, args, gemini):
+        self.args = args
+        self.gemini = gemini
+        self.mix = self.parse_mix(args.mix)
+        self.next_id = 10 ** 15
+        self.latencies = {name: [] for name in self.mix}
+        self.outcomes = {name: {} for name in self.mix}
+        self.lag = []
+
+    @staticmethod
+    def parse_mix(mix):
+        weights = {}
+        for item in mix.split(","):
+            name, _, weight = item.partition("=")
+            if name not in COMMANDS:
+                sys.exit(f"unknown command in --mix: {name} (choose from {', '.join(COMMANDS)})")
+            weights[name] = float(weight or 1)
+        return weights
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def context(self, command, attachments=()):
+        user_id = random.randrange(1, self.args.users + 1)
+        guild_id = random.randrange(1, self.args.guilds + 1)
+        return FakeContext(command, self.new_id(), user_id, guild_id, guild_id * 100 + user_id % 5,
+                           self.args.discord_latency / 1000, attachments)
+
+    async def one_request(self, number):
+        command = random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        attachments = ()
+        if command == "analyze":
+            data = PNG + (str(number).encode() if self.args.unique else b"")
+            attachments = [FakeAttachment(self.new_id(), data)]
+        ctx = self.context(command, attachments)
+        start = time.perf_counter()
+        await bot.start_request(ctx)
+        try:
+            async with bot.lanes[bot.command_lane(ctx)].slot():
+                await COMMANDS[command](ctx, number, self.args)
+        except bot.LaneFull as e:
+            await bot.shed_request(ctx, e)
+        except Exception:
+            ctx.command_failed = True
+            ctx.sent.append("❌ unhandled")
+        finally:
+            await bot.finish_request(ctx)
+        self.latencies[command].append(time.perf_counter() - start)
+        outcome = ctx.outcome()
+        self.outcomes[command][outcome] = self.outcomes[command].get(outcome, 0) + 1
+
+    async def worker(self, numbers):
+        for number in numbers:
+            await self.one_request(number)
+
+    async def watch_loop(self, interval=0.01):
+        """Event loop lag = how late a short sleep wakes up"""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.lag.append(loop.time() - start - interval)
+
+    async def run(self):
+        await bot.settings_store.start()
+        await bot.conversation_store.start()
+        if bot.analysis_cache:
+            await bot.analysis_cache.start()
+        watcher = asyncio.create_task(self.watch_loop())
+        numbers = iter(range(self.args.requests))
+        start = time.perf_counter()
+        await asyncio.gather(*(self.worker(numbers) for _ in range(self.args.concurrency)))
+        elapsed = time.perf_counter() - start
+        watcher.cancel()
+        await asyncio.gather(*bot.background_tasks, return_exceptions=True)
+        await bot.conversation_store.close()
+        await bot.settings_store.close()
+        return elapsed
+
+async def run_ask(ctx, number, args):
+    question = random.choice(QUESTIONS)
+    if args.unique:
+        question = f"{question} (#{number})"
+    await bot.ask.callback(ctx, question=question)
+
+async def run_summarize(ctx, number, args):
+    # summarizing needs a conversation, seed one the way !ask would
+    conv = await bot.get_conversation(ctx.author.id, ctx.channel.id)
+    if not conv.history:
+        conv.add_message("user", random.choice(QUESTIONS))
+        conv.add_message("assistant", ANSWER)
+    await bot.summarize_conversation.callback(ctx)
+
+async def run_analyze(ctx, number, args):
+    await bot.analyze_image.callback(ctx)
+
+async def run_set(ctx, number, args):
+    await bot.set_setting.callback(ctx, "style", random.choice(list(bot.AVAILABLE_STYLES)))
+
+COMMANDS = {
+    "ask": run_ask,
+    "summarize": run_summarize,
+    "analyze": run_analyze,
+    "set": run_set,
+}
+
+# Report
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def rss_mb():
+    """Current resident set size (linux), falls back to the peak"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # bytes on macos, KB elsewhere
+
+def build_report(test, elapsed, rss_before):
+    total = sum(len(values) for values in test.latencies.values())
+    rss_after = rss_mb()
+    return {
+        "requests": total,
+        "concurrency": test.args.concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "commands": {
+            name: {
+                "count": len(values),
+                "outcomes": test.outcomes[name],
+                "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+            }
+            for name, values in test.latencies.items() if values
+        },
+        "loop_lag_ms": {
+            "p50": round(percentile(test.lag, 0.50) * 1000, 2),
+            "p99": round(percentile(test.lag, 0.99) * 1000, 2),
+            "max": round(max(test.lag, default=0.0) * 1000, 2),
+        },
+        "rss_mb": {"before": round(rss_before, 1), "after": round(rss_after, 1), "peak": round(max(rss_after, peak_rss_mb()), 1)},
+        "fake_gemini": {"calls": test.gemini.calls, "streams": test.gemini.streams, "injected_errors": test.gemini.errors},
+        "bot": {
+            "coalescing": bot.inflight.stats(),
+            "response_cache": bot.response_cache.stats(),
+            "lanes": {name: lane.stats() for name, lane in bot.lanes.items()},
+        },
+    }
+
+def print_report(report):
+    print(f"{report['requests']} requests, concurrency {report['concurrency']}, "
+          f"{report['elapsed_s']}s -> {report['throughput_rps']} req/s")
+    print(f"  {'command':<10} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}  outcomes")
+    for name, stats in report["commands"].items():
+        outcomes = ", ".join(f"{key}={value}" for key, value in sorted(stats["outcomes"].items()))
+        print(f"  {name:<10} {stats['count']:>6} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}  {outcomes}")
+    lag = report["loop_lag_ms"]
+    print(f"  event loop lag: p50 {lag['p50']}ms, p99 {lag['p99']}ms, max {lag['max']}ms")
+    rss = report["rss_mb"]
+    print(f"  rss: {rss['before']}MB before, {rss['after']}MB after, {rss['peak']}MB peak")
+    fake = report["fake_gemini"]
+    print(f"  fake gemini: {fake['calls']} calls ({fake['streams']} streamed), {fake['injected_errors']} injected errors")
+    print(f"  coalescing: {report['bot']['coalescing']}")
+    for name, stats in report["bot"]["lanes"].items():
+        print(f"  lane {name:<8} completed {stats['completed']}, rejected {stats['rejected']}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline load test for the bot's command handlers")
+    parser.add_argument("--concurrency", type=int, default=50, help="requests in flight at once")
+    parser.add_argument("--requests", type=int, default=2000, help="total requests")
+    parser.add_argument("--mix", default="ask=70,summarize=10,analyze=10,set=10", help="command=weight,...")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=800, help="fake gemini total latency, ms")
+    parser.add_argument("--ttft", type=float, default=300, help="fake gemini time to first chunk, ms")
+    parser.add_argument("--chunks", type=int, default=8, help="chunks per streamed answer")
+    parser.add_argument("--response-chars", type=int, default=1500)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of fake gemini calls that fail (retried)")
+    parser.add_argument("--discord-latency", type=float, default=50, help="ms per send / edit")
+    parser.add_argument("--no-stream", action="store_true", help="STREAM_RESPONSES off")
+    parser.add_argument("--unique", action="store_true", help="make every question / image unique (no cache hits)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's logs")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    if args.verbose:
+        bot.setup_logging()
+    else:
+        logging.disable(logging.CRITICAL)
+
+    gemini = FakeGemini(args.latency / 1000, args.ttft / 1000, args.chunks, args.error_rate, args.response_chars)
+    bot.get_model = lambda name, system_instruction=None: FakeModel(gemini)
+    bot.STREAM_RESPONSES = not args.no_stream
+
+    rss_before = rss_mb()
+    test = LoadTest(args, gemini)
+    try:
+        elapsed = asyncio.run(test.run())
+    finally:
+        shutil.rmtree(STATE_DIR, ignore_errors=True)
+    report = build_report(test, elapsed, rss_before)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+# Intent classification of inflected questions (python -m pytest -q)
+import pytest
+import bot
+
+@pytest.mark.parametrize("question, kind", [
+    ("debugging a segfault", "debug"),
+    ("can you help me debugging this script", "debug"),
+    ("my build failure on CI", "debug"),
+    ("my code has errors", "debug"),
+    ("I compared postgres and mysql", "comparison"),
+    ("describing the architecture", "explanation"),
+    ("write a function to sort a list", "code"),
+    ("what is the prefix of this string", "explanation"),
+])
+def test_kind(question, kind):
+    assert bot.classify_question(question).kind == kind
+
+def test_followup_phrase():
+    intent = bot.classify_question("explain more please")
+    assert intent.kind == "explanation" and intent.is_followup
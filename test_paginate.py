@@ -0,0 +1,31 @@
+# Regression tests for paginate (python -m pytest -q)
+import bot
+
+def fences(page):
+    return sum(1 for line in page.split("\n") if bot.code_fence(line))
+
+def check(text, limit, payload, balanced=True):
+    pages = bot.paginate(text, limit)
+    assert pages
+    assert all(len(page) <= limit for page in pages)
+    assert not balanced or all(fences(page) % 2 == 0 for page in pages)  # every page closes what it opens
+    for char in payload:
+        assert "".join(pages).count(char) == text.count(char)
+    return pages
+
+def test_long_opener_in_field():
+    pages = check("```python " + "x" * 1010 + "\ncode\n```", bot.EMBED_FIELD_LIMIT, "x")
+    assert "code" in pages[-1]
+
+def test_long_opener_in_description():
+    check("```" + "a" * 4090 + "\n" + "b" * 5000 + "\n```", bot.EMBED_DESCRIPTION_LIMIT, "b")
+
+def test_opener_longer_than_page():
+    check("```" + "a" * 3000 + "\n" + "b" * 3000 + "\n```", bot.EMBED_FIELD_LIMIT, "b")
+
+def test_reopened_block_keeps_short_language_tag():
+    pages = check("```" + "c" * 40 + " extra info\n" + "y" * 3000 + "\n```", bot.EMBED_FIELD_LIMIT, "y")
+    assert all(page.startswith("```" + "c" * bot.FENCE_LANG_MAX + "\n") for page in pages[1:])
+
+def test_huge_marker_is_text():
+    check("`" * 2000 + "\nfoo\n" + "`" * 2000, bot.EMBED_FIELD_LIMIT, "fo`", balanced=False)
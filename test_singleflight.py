@@ -0,0 +1,40 @@
+# Coalescing of identical upstream calls (python -m pytest -q)
+import asyncio
+import bot
+
+def test_follower_survives_cancelled_leader():
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return len(calls)
+
+    async def main():
+        flight = bot.SingleFlight()
+        leader = asyncio.create_task(flight.do("k", fn))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do("k", fn))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        assert await follower == (2, False)  # retried as the new leader
+        assert leader.cancelled() and not flight.calls
+
+    asyncio.run(main())
+
+def test_cancelled_follower_leaves_leader_running():
+    async def fn():
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def main():
+        flight = bot.SingleFlight()
+        leader = asyncio.create_task(flight.do("k", fn))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do("k", fn))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        assert await leader == ("answer", False)
+        assert follower.cancelled()
+
+    asyncio.run(main())
@@ -0,0 +1,46 @@
+# Slash commands run the prefix handlers on a context built from the interaction (python -m pytest -q)
+import asyncio
+from types import SimpleNamespace
+import discord
+import bot
+
+class Response:
+    async def defer(self, **kwargs):
+        pass
+
+def interaction(command, **options):
+    state = bot.bot._connection
+    return SimpleNamespace(
+        client=bot.bot, command=bot.bot.tree.get_command(command), data={"type": 1}, message=None, id=1,
+        channel_id=2, channel=None, guild_id=None, _state=state, user=SimpleNamespace(id=3),
+        namespace=list(options.items()), response=Response(), created_at=discord.utils.utcnow(),
+        command_failed=False,
+    )
+
+def test_ask_with_image_has_one_attachment(monkeypatch):
+    image = discord.Attachment(state=bot.bot._connection, data={
+        "id": 7, "filename": "cat.png", "size": 10, "url": "https://cdn.example/cat.png",
+        "proxy_url": "https://cdn.example/cat.png", "content_type": "image/png",
+    })
+    seen = []
+
+    async def handler(ctx, question):
+        seen.append(list(ctx.message.attachments))
+
+    monkeypatch.setattr(bot, "ask", SimpleNamespace(callback=handler))
+    asyncio.run(bot.slash_ask.callback(interaction("ask", question="hi", image=image), question="hi", image=image))
+    assert seen == [[image]]
+
+def test_error_without_command_still_renders(monkeypatch):
+    sent = []
+
+    class Followup:
+        async def send(self, message, **kwargs):
+            sent.append(message)
+
+    monkeypatch.setattr(bot, "metrics", bot.Metrics())
+    bot.metrics.inc("bot_command_errors_total", command="ask", error="ValueError")
+    failed = SimpleNamespace(command=None, response=SimpleNamespace(is_done=lambda: True), followup=Followup())
+    asyncio.run(bot.on_app_command_error(failed, ValueError("boom")))
+    assert sent and 'command="unknown"' in bot.metrics.render()
+    assert "bot_command_errors_total[unknown][ValueError]" in bot.metrics.counter_summary()